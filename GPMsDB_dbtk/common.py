@@ -10,9 +10,11 @@ __status__ = 'Development'
 
 import os
 import errno
+import gzip
 import sys
 import logging
 import time
+import resource
 import ntpath
 
 import GPMsDB_dbtk
@@ -47,11 +49,36 @@ def makeSurePathExists(path):
 
 def genomeIdFromFilename(filename):
     genId = os.path.basename(filename)
+    if genId.endswith('.gz'):
+        genId = genId[0:-3]
     genId = os.path.splitext(genId)[0]
 
     return genId
 
 
+def openSeqFile(seqFile):
+    if seqFile.endswith('.gz'):
+        return gzip.open(seqFile, 'rb')
+
+    return open(seqFile, 'rb')
+
+
+def fastaSeqLengths(fastaFile):
+    # only sequence ids and lengths are kept, so genomes of any size can be
+    # scanned without holding their sequences in memory
+    seqLens = {}
+    seqId = None
+    with openSeqFile(fastaFile) as f:
+        for line in f:
+            if line[0:1] == b'>':
+                seqId = line[1:].split(None, 1)[0].decode()
+                seqLens[seqId] = 0
+            elif seqId is not None:
+                seqLens[seqId] += len(line.strip().replace(b' ', b''))
+
+    return seqLens
+
+
 class StopWatch():
     def __init__(self, logger):
         self.time_start = time.time()
@@ -64,8 +91,8 @@ class StopWatch():
 
     def lap(self):
         now = time.time()
-        self.time_latest = now
         lap = now - self.time_latest
+        self.time_latest = now
         total = now - self.time_start
         lap2 = int(lap + 0.5)
         h = lap2 // 3600 
@@ -79,6 +106,27 @@ class StopWatch():
             f"\n {{lap time: {h:02}:{m:02}:{s:02}, total time: {h2:02}:{m2:02}:{s2:02}}}")
 
 
+class StageTimer():
+    # wall time and CPU time of a stage of work. CPU time is split into this
+    # process and the child processes it waited for during the stage.
+    def __init__(self):
+        self.wall_start = time.time()
+        self.self_start = resource.getrusage(resource.RUSAGE_SELF)
+        self.children_start = resource.getrusage(resource.RUSAGE_CHILDREN)
+
+    def stop(self):
+        selfUsage = resource.getrusage(resource.RUSAGE_SELF)
+        childrenUsage = resource.getrusage(resource.RUSAGE_CHILDREN)
+
+        return {'wall_s': round(time.time() - self.wall_start, 3),
+                'cpu_s': round(cpuTime(selfUsage) - cpuTime(self.self_start), 3),
+                'child_cpu_s': round(cpuTime(childrenUsage) - cpuTime(self.children_start), 3)}
+
+
+def cpuTime(usage):
+    return usage.ru_utime + usage.ru_stime
+
+
 def version():
     versionFile = open(os.path.join(GPMsDB_dbtk.__path__[0], 'VERSION'))
     return versionFile.readline().strip()
@@ -8,11 +8,28 @@ __maintainer__ = 'Yuji Sekiguchi'
 __email__ = 'y.sekiguchi@aist.go.jp'
 __status__ = 'Development'
 
+import os
+import sys
+import json
+import fcntl
 import logging
 import pickle
+import sqlite3
+import time
+from contextlib import contextmanager
+from urllib.request import pathname2url
 
 from GPMsDB_dbtk.common import checkFileExists
 from GPMsDB_dbtk.defaultValues import DefaultValues
+from GPMsDB_dbtk.peakStore import PeakStore
+
+
+def openDb():
+  # the SQLite store is used once the custom database has been migrated
+  if os.path.exists(DefaultValues.CUSTOM_DB_SQLITE):
+      return SqliteDb()
+
+  return Db()
 
 
 class Db(object):
@@ -27,112 +44,181 @@ class Db(object):
       checkFileExists(self.db_file_genes)
       checkFileExists(self.db_file_names)
       checkFileExists(self.db_file_tax)
+      self.journal_file = DefaultValues.CUSTOM_DB_JOURNAL
+      self.generation_file = DefaultValues.CUSTOM_DB_GENERATION
+      self.bLocked = False
       self.logger = logging.getLogger('GPMsDB_tk')
       self.ribo_db = {}
       self.others_db = {}
       self.genes_db = {}
+      self.names_db = {}
       self.tax_db = {}
 
-  def list(self):
-      with open(self.db_file_r, 'rb') as f:
-         try:
-             ribosomals = pickle.load(f)
-             self.logger.info('[db_list] ' + str(len(ribosomals.keys())) + " entries found in the custom db")
-             for i in ribosomals.keys():
-                 if i == "":
-                     pass
-                 else:
-                     self.logger.info(i)
-         except EOFError:
-             self.logger.info("no entry found in the custom db")
-
-  def add(self, peakFile):
-      checkFileExists(peakFile)
+  def dbFiles(self):
+      return [(self.db_file_r, 'ribo_db'), (self.db_file_o, 'others_db'), (self.db_file_genes, 'genes_db'),
+              (self.db_file_names, 'names_db'), (self.db_file_tax, 'tax_db')]
+
+  @contextmanager
+  def writeLock(self):
+      # advisory lock serialising writers of the custom db; readers never take it
+      with open(DefaultValues.CUSTOM_DB_LOCK, 'a') as lock:
+          try:
+              fcntl.flock(lock, fcntl.LOCK_EX | fcntl.LOCK_NB)
+          except BlockingIOError:
+              self.logger.info('Waiting for another process updating the custom db')
+              fcntl.flock(lock, fcntl.LOCK_EX)
+
+          self.bLocked = True
+          try:
+              yield
+          finally:
+              self.bLocked = False
+              fcntl.flock(lock, fcntl.LOCK_UN)
+
+  def list(self, idPattern=None, taxonomy=None, minPeaks=None, maxPeaks=None, outFormat='tsv', outFile=None):
+      # only the per-genome header arrays of the peak store are read
+      store = self.peakStore()
+      numRibosomals, numOthers = store.peakCounts()
+
+      indices = store.select(idPattern, taxonomy, minPeaks, maxPeaks)
+      self.logger.info('[db_list] ' + str(store.numGenomes()) + " entries found in the custom db")
+      if store.numGenomes() == 0:
+          self.logger.info("no entry found in the custom db")
+          return
+
+      fout = open(outFile, 'w') if outFile else sys.stdout
+      if outFormat == 'json':
+          fout.write('[')
+      else:
+          fout.write('Genome Id\tName\tTaxonomy\t# ribosomal peaks\t# other peaks\n')
+
+      numListed = 0
+      for i in indices:
+          if store.ids[i] == "":
+              continue
+
+          if outFormat == 'json':
+              entry = {'id': str(store.ids[i]), 'name': str(store.names[i]), 'taxonomy': str(store.taxonomy[i]),
+                       'ribosomal_peaks': int(numRibosomals[i]), 'other_peaks': int(numOthers[i])}
+              fout.write((',\n ' if numListed else '\n ') + json.dumps(entry))
+          else:
+              fout.write('%s\t%s\t%s\t%d\t%d\n' % (store.ids[i], store.names[i], store.taxonomy[i], numRibosomals[i], numOthers[i]))
+          numListed += 1
+
+      if outFormat == 'json':
+          fout.write('\n]\n')
+      if outFile:
+          fout.close()
+
+      self.logger.info(str(numListed) + ' entries listed')
+
+  def add(self, peakFiles):
+      for peakFile in peakFiles:
+          checkFileExists(peakFile)
       Db.checkDb(self)
 
+      ribosomals, others, genes, names, tax, a, duplicates = self.parsePeakFiles(peakFiles)
+
+      with self.writeLock():
+          Db.loadDb(self)
+
+          self.reportDuplicates(duplicates, [i for i in ribosomals.keys() if i in self.ribo_db])
+          for j in ribosomals.keys():
+              self.ribo_db[j] = ribosomals[j]
+              self.others_db[j] = others[j]
+              self.genes_db[j] = genes[j]
+              try:
+                  self.names_db[j] = names[j]
+              except:
+                  self.names_db[j] = ""
+              try:
+                  self.tax_db[j] = tax[j]
+              except:
+                  self.tax_db[j] = ""
+
+          Db.dumpDb(self)
+
+      self.logger.info(str(a) + " entries found and " + str(len(ribosomals)) + " genomes added in the custom db")
+
+  def parsePeakFiles(self, peakFiles):
+      # rows of all peak lists are collected before the db is touched; blank
+      # lines and repeated headers of concatenated files are skipped
       genes = {}
       names = {}
       tax = {}
       ribosomals = {}
       others = {}
+      duplicates = []
 
       a = 0
-      for line in open(peakFile):
-          if line.rstrip() == "":
-              break
-          if "Genome Id" in line:
-              continue
+      for peakFile in peakFiles:
+          for line in open(peakFile):
+              if line.rstrip() == "":
+                  continue
+              if "Genome Id" in line:
+                  continue
 
-          a += 1
-          element = line.split("\t")
-          id = "GCC_" + element[0].rstrip()
-          ribosomals[id] = []
-          others[id] = []
-          if len(element) >= 7:
-              genes[id] = int(element[1]) + int(element[2])
-              names[id] = element[5]
-              tax[id] = element[6].rstrip()
-          elif len(element) == 6:
-              genes[id] = int(element[1]) + int(element[2])
-              names[id] = element[5].rstrip()
-          else:
-              genes[id] = int(element[1]) + int(element[2])
+              element = line.rstrip('\n').split("\t")
+              try:
+                  numGenes = int(element[1]) + int(element[2])
+                  item_r = element[3].replace('"',"").split(",")
+                  item_o = element[4].replace('"',"").split(",")
+              except (IndexError, ValueError):
+                  self.logger.warning('Skipping incomplete line in ' + peakFile + ': ' + line.strip()[:50])
+                  continue
 
-          item_r = element[3].replace('"',"").split(",")
-          for n in item_r:
-              ribosomals[id].append(n)
-          item_o = element[4].replace('"',"").split(",")
-          for j in item_o:
-              others[id].append(j)
+              a += 1
+              id = "GCC_" + element[0].rstrip()
+              if id in ribosomals:
+                  duplicates.append(id)
+              ribosomals[id] = item_r
+              others[id] = item_o
+              genes[id] = numGenes
+              if len(element) >= 7:
+                  names[id] = element[5]
+                  tax[id] = element[6].rstrip()
+              elif len(element) == 6:
+                  names[id] = element[5].rstrip()
 
-      Db.loadDb(self)
+      return ribosomals, others, genes, names, tax, a, duplicates
 
-      for i in ribosomals.keys():
-          if i in self.ribo_db.keys():
-              self.logger.info('The same genome id was found in the new list')
+  def reportDuplicates(self, duplicates, existing):
+      # ids given more than once keep their last row; ids already in the db
+      # are replaced
+      if duplicates:
+          self.logger.info(str(len(set(duplicates))) + ' genome ids were found more than once in the new lists; the last entry is used')
+          for i in sorted(set(duplicates)):
+              self.logger.info('Changing the id is reccomended for the genome: ' + i)
+      if existing:
+          self.logger.info(str(len(existing)) + ' genome ids were already in the custom db and are replaced')
+          for i in existing:
               self.logger.info('Changing the id is reccomended for the genome: ' + i)
-              break
-      for j in ribosomals.keys():
-          self.ribo_db[j] = ribosomals[j]
-          self.others_db[j] = others[j]
-          self.genes_db[j] = genes[j]
-          try:
-              self.names_db[j] = names[j]
-          except:
-              self.names_db[j] = ""
-          try:
-              self.tax_db[j] = tax[j]
-          except:
-              self.tax_db[j] = ""
-
-      Db.dumpDb(self)
-
-      self.logger.info(str(a) + " entries found and added in the custom db")
-
 
   def remove(self, accessions):
       Db.checkDb(self)
-      Db.loadDb(self)
-
-      list = []
-      acces = accessions.split(",")
-      for name in acces:
-          name_fine = name.rstrip().lstrip()
-          if name_fine in self.ribo_db.keys():
-              list.append(name_fine)
-          else:
-              self.logger.info('Id is not found in the custom database: ' + name_fine)
 
-      self.logger.info(str(len(list)) + ' genomes to be removed')
+      with self.writeLock():
+          Db.loadDb(self)
+
+          list = []
+          acces = accessions.split(",")
+          for name in acces:
+              name_fine = name.rstrip().lstrip()
+              if name_fine in self.ribo_db.keys():
+                  list.append(name_fine)
+              else:
+                  self.logger.info('Id is not found in the custom database: ' + name_fine)
+
+          self.logger.info(str(len(list)) + ' genomes to be removed')
 
-      for l in list:
-          self.ribo_db.pop(l)
-          self.others_db.pop(l)
-          self.genes_db.pop(l)
-          self.names_db.pop(l)
-          self.tax_db.pop(l)
+          for l in list:
+              self.ribo_db.pop(l)
+              self.others_db.pop(l)
+              self.genes_db.pop(l)
+              self.names_db.pop(l)
+              self.tax_db.pop(l)
 
-      Db.dumpDb(self)
+          Db.dumpDb(self)
 
   def checkDb(self):
       try:
@@ -148,25 +234,354 @@ class Db(object):
           return False
 
   def loadDb(self):
-      with open(self.db_file_r, 'rb') as f:
-          self.ribo_db = pickle.load(f)
-      with open(self.db_file_o, 'rb') as f:
-          self.others_db = pickle.load(f)
-      with open(self.db_file_genes, 'rb') as f:
-          self.genes_db = pickle.load(f)
-      with open(self.db_file_names, 'rb') as f:
-          self.names_db = pickle.load(f)
-      with open(self.db_file_tax, 'rb') as f:
-          self.tax_db = pickle.load(f)
+      if self.bLocked:
+          self.recover()
+          self.readFiles()
+          return
+
+      # optimistic snapshot without the lock: the files are read again if a
+      # commit was in progress or completed while they were being read
+      for attempt in range(DefaultValues.CUSTOM_DB_READ_RETRIES):
+          if not os.path.exists(self.journal_file):
+              generation = self.generation()
+              self.readFiles()
+              if not os.path.exists(self.journal_file) and generation == self.generation():
+                  return
+          time.sleep(0.1)
+
+      # a writer seems to have died during its commit; readers never take the
+      # lock, so it is left to the next update to complete
+      self.logger.error('The custom db is being updated or a previous update was interrupted.')
+      self.logger.error('Please try again, or run update_db or remove_genome to complete the interrupted update.')
+      sys.exit(1)
+
+  def readFiles(self):
+      for db_file, db in self.dbFiles():
+          with open(db_file, 'rb') as f:
+              try:
+                  setattr(self, db, pickle.load(f))
+              except EOFError:
+                  setattr(self, db, {})
 
   def dumpDb(self):
-      with open(self.db_file_r, mode='wb') as f:
-          pickle.dump(self.ribo_db, f)
-      with open(self.db_file_o, mode='wb') as f:
-          pickle.dump(self.others_db, f)
-      with open(self.db_file_genes, mode='wb') as f:
-          pickle.dump(self.genes_db, f)
-      with open(self.db_file_names, mode='wb') as f:
-          pickle.dump(self.names_db, f)
-      with open(self.db_file_tax, mode='wb') as f:
-          pickle.dump(self.tax_db, f)
+      self.writeFiles()
+      self.savePeakStore()
+
+  def writeFiles(self):
+      # the files are written next to the current ones and only renamed into
+      # place once all are on disk; the journal records that the new set is
+      # complete so an interrupted commit can be rolled forward
+      for db_file, db in self.dbFiles():
+          with open(db_file + '.tmp', mode='wb') as f:
+              pickle.dump(getattr(self, db), f)
+              f.flush()
+              os.fsync(f.fileno())
+
+      Db.writeSynced(self.journal_file, str(self.generation() + 1))
+      self.commitJournal()
+
+  def commitJournal(self):
+      with open(self.journal_file) as f:
+          generation = int(f.read())
+
+      for db_file, db in self.dbFiles():
+          if os.path.exists(db_file + '.tmp'):
+              os.replace(db_file + '.tmp', db_file)
+      Db.syncDir(self.journal_file)
+
+      Db.writeSynced(self.generation_file, str(generation))
+      os.remove(self.journal_file)
+      Db.syncDir(self.journal_file)
+
+  def recover(self):
+      # called with the lock held: complete a commit whose journal was written,
+      # drop temporary files of one that never got that far
+      if os.path.exists(self.journal_file):
+          self.logger.info('Completing an interrupted update of the custom db')
+          self.commitJournal()
+      else:
+          for db_file, db in self.dbFiles():
+              if os.path.exists(db_file + '.tmp'):
+                  os.remove(db_file + '.tmp')
+
+  def generation(self):
+      # number of commits made to the pickle files; 0 for older databases
+      try:
+          with open(self.generation_file) as f:
+              return int(f.read())
+      except (OSError, ValueError):
+          return 0
+
+  @staticmethod
+  def writeSynced(fileName, text):
+      with open(fileName + '.tmp', 'w') as f:
+          f.write(text)
+          f.flush()
+          os.fsync(f.fileno())
+      os.replace(fileName + '.tmp', fileName)
+
+  @staticmethod
+  def syncDir(fileName):
+      fd = os.open(os.path.dirname(fileName), os.O_RDONLY)
+      try:
+          os.fsync(fd)
+      finally:
+          os.close(fd)
+
+  def stamp(self):
+      # identifies the state of the peak files the columnar store was built from
+      stamp = []
+      for db_file in [self.db_file_r, self.db_file_o]:
+          st = os.stat(db_file)
+          stamp.append([st.st_mtime_ns, st.st_size])
+
+      return stamp
+
+  def savePeakStore(self, stamp=None):
+      # called by writers with the lock held
+      store = PeakStore(DefaultValues.CUSTOM_PEAK_STORE)
+      store.fromDicts(self.ribo_db, self.others_db, self.names_db, self.tax_db)
+      store.save(self.stamp() if stamp is None else stamp)
+
+      return store
+
+  def peakStore(self):
+      # memory-mapped peaks of all genomes as saved by the last update. Only
+      # writers save the store; when it is missing or older than the db the
+      # peaks are read into memory instead
+      store = PeakStore(DefaultValues.CUSTOM_PEAK_STORE)
+      if store.load(self.stamp()):
+          return store
+
+      self.logger.info('The peak index of the custom db is not up to date; reading all peaks. It is saved again by the next update_db or remove_genome.')
+      self.loadDb()
+      store.fromDicts(self.ribo_db, self.others_db, self.names_db, self.tax_db)
+      store.buildIndex()
+
+      return store
+
+  def queryMass(self, masses, ppm=None, da=None):
+      # peaks of all genomes within the tolerance of each query mass
+      if ppm is None and da is None:
+          ppm = DefaultValues.QUERY_MASS_PPM
+
+      store = self.peakStore()
+
+      hits = []
+      observed, genomes, peaks, classes = store.matches(masses, ppm, da)
+      for q, g, peak, c in zip(observed, genomes, peaks, classes):
+          hits.append((masses[q], str(store.ids[g]), float(peak), PeakStore.CLASS_NAMES[c]))
+
+      return hits
+
+
+class SqliteDb(Db):
+  # single-file custom database; genome rows and peak payloads are kept in
+  # separate tables so that listing never reads the peaks
+
+  SCHEMA = [
+      'CREATE TABLE IF NOT EXISTS genomes (id TEXT PRIMARY KEY, genes INTEGER, name TEXT, taxonomy TEXT)',
+      'CREATE TABLE IF NOT EXISTS peaks (id TEXT PRIMARY KEY REFERENCES genomes(id) ON DELETE CASCADE, ribosomals TEXT, others TEXT)'
+  ]
+
+  def __init__(self, db_file=None, bCreate=False):
+      self.db_file = db_file if db_file else DefaultValues.CUSTOM_DB_SQLITE
+      if not bCreate:
+          checkFileExists(self.db_file)
+      self.bLocked = False
+      self.logger = logging.getLogger('GPMsDB_tk')
+      self.ribo_db = {}
+      self.others_db = {}
+      self.genes_db = {}
+      self.names_db = {}
+      self.tax_db = {}
+
+  def connect(self, bReadOnly=False):
+      # readers open the db read-only and never change its schema
+      if bReadOnly:
+          return sqlite3.connect('file:' + pathname2url(os.path.abspath(self.db_file)) + '?mode=ro', uri=True, timeout=600)
+
+      # writers open their transactions themselves, see writeTransaction
+      conn = sqlite3.connect(self.db_file, timeout=600, isolation_level=None)
+      conn.execute('PRAGMA journal_mode=WAL')
+      conn.execute('PRAGMA foreign_keys=ON')
+      for statement in SqliteDb.SCHEMA:
+          conn.execute(statement)
+
+      return conn
+
+  def checkDb(self):
+      if not os.access(self.db_file, os.W_OK):
+          self.logger.info("You do not seem to have permission to edit the custom db files")
+          self.logger.info("Please try again with updated privileges.")
+          return False
+
+      return True
+
+  def add(self, peakFiles):
+      for peakFile in peakFiles:
+          checkFileExists(peakFile)
+      self.checkDb()
+
+      ribosomals, others, genes, names, tax, a, duplicates = self.parsePeakFiles(peakFiles)
+
+      conn = self.connect()
+      try:
+          with self.writeTransaction(conn) as stamp:
+              existing = [i for (i,) in conn.execute('SELECT id FROM genomes') if i in ribosomals]
+              self.reportDuplicates(duplicates, existing)
+
+              self.insertGenomes(conn, ribosomals, others, genes, names, tax)
+      finally:
+          conn.close()
+
+      self.updatePeakStore(stamp, lambda store: store.add(ribosomals, others, names, tax))
+
+      self.logger.info(str(a) + " entries found and " + str(len(ribosomals)) + " genomes added in the custom db")
+
+  def insertGenomes(self, conn, ribosomals, others, genes, names, tax):
+      conn.executemany('INSERT OR REPLACE INTO genomes (id, genes, name, taxonomy) VALUES (?, ?, ?, ?)',
+                       ((j, genes[j], names.get(j, ""), tax.get(j, "")) for j in ribosomals.keys()))
+      conn.executemany('INSERT OR REPLACE INTO peaks (id, ribosomals, others) VALUES (?, ?, ?)',
+                       ((j, ','.join(ribosomals[j]), ','.join(others[j])) for j in ribosomals.keys()))
+
+  def remove(self, accessions):
+      self.checkDb()
+
+      conn = self.connect()
+      try:
+          with self.writeTransaction(conn) as stamp:
+              list = []
+              acces = accessions.split(",")
+              for name in acces:
+                  name_fine = name.rstrip().lstrip()
+                  if conn.execute('SELECT 1 FROM genomes WHERE id = ?', (name_fine,)).fetchone():
+                      list.append(name_fine)
+                  else:
+                      self.logger.info('Id is not found in the custom database: ' + name_fine)
+
+              self.logger.info(str(len(list)) + ' genomes to be removed')
+
+              conn.executemany('DELETE FROM genomes WHERE id = ?', ((l,) for l in list))
+      finally:
+          conn.close()
+
+      self.updatePeakStore(stamp, lambda store: store.remove(list))
+
+  def updatePeakStore(self, stamp, update):
+      # after a change committed as stamp, the store is changed in place if
+      # it holds the state just before; otherwise it is rebuilt from the db
+      # unless another writer has already brought it up to date
+      with self.writeLock():
+          store = PeakStore(DefaultValues.CUSTOM_PEAK_STORE)
+          if store.load(stamp - 1):
+              update(store)
+              store.save(stamp)
+          elif not store.load(self.stamp()):
+              self.loadDb()
+              self.savePeakStore(self.loadedStamp)
+
+  def loadDb(self):
+      self.ribo_db, self.others_db, self.genes_db, self.names_db, self.tax_db = {}, {}, {}, {}, {}
+
+      conn = self.connect(bReadOnly=True)
+      try:
+          # both tables and the stamp are read from the same snapshot
+          conn.execute('BEGIN')
+          self.loadedStamp = conn.execute('PRAGMA user_version').fetchone()[0]
+          for id, genes, name, taxonomy in conn.execute('SELECT id, genes, name, taxonomy FROM genomes ORDER BY rowid'):
+              self.genes_db[id] = genes
+              self.names_db[id] = name
+              self.tax_db[id] = taxonomy
+          for id, ribosomals, others in conn.execute('SELECT id, ribosomals, others FROM peaks ORDER BY rowid'):
+              self.ribo_db[id] = ribosomals.split(",")
+              self.others_db[id] = others.split(",")
+          conn.rollback()
+      finally:
+          conn.close()
+
+  def dumpDb(self):
+      conn = self.connect()
+      try:
+          with self.writeTransaction(conn) as stamp:
+              conn.execute('DELETE FROM genomes')
+              self.insertGenomes(conn, self.ribo_db, self.others_db, self.genes_db, self.names_db, self.tax_db)
+      finally:
+          conn.close()
+
+      with self.writeLock():
+          self.savePeakStore(stamp)
+
+  @contextmanager
+  def writeTransaction(self, conn):
+      # user_version counts committed changes and serves as the stamp of the
+      # columnar peak store; the peak store is only updated in place when it
+      # was built from the previous state. BEGIN IMMEDIATE takes the write
+      # lock of the db before the stamp is read, so the rows and the new stamp
+      # are committed together and no two writers get the same stamp
+      conn.execute('BEGIN IMMEDIATE')
+      try:
+          stamp = conn.execute('PRAGMA user_version').fetchone()[0] + 1
+          conn.execute('PRAGMA user_version = %d' % stamp)
+          yield stamp
+      except BaseException:
+          conn.execute('ROLLBACK')
+          raise
+
+      conn.execute('COMMIT')
+
+  def export(self):
+      # the pickle files are rewritten from a snapshot of the SQLite file; the
+      # peak store already matches the SQLite file and is left alone
+      self.loadDb()
+
+      target = Db()
+      with target.writeLock():
+          target.recover()
+          target.ribo_db = self.ribo_db
+          target.others_db = self.others_db
+          target.genes_db = self.genes_db
+          target.names_db = self.names_db
+          target.tax_db = self.tax_db
+          target.writeFiles()
+
+      self.logger.info(str(len(self.ribo_db)) + ' entries exported to the pickle files of the custom db')
+
+  def stamp(self):
+      conn = self.connect(bReadOnly=True)
+      try:
+          return conn.execute('PRAGMA user_version').fetchone()[0]
+      finally:
+          conn.close()
+
+  @staticmethod
+  def migrate(db_file=None):
+      logger = logging.getLogger('GPMsDB_tk')
+
+      source = Db()
+      with source.writeLock():
+          source.loadDb()
+          generation = source.generation()
+
+      target = SqliteDb(db_file, bCreate=True)
+      target.ribo_db = source.ribo_db
+      target.others_db = source.others_db
+      target.genes_db = source.genes_db
+      target.names_db = source.names_db
+      target.tax_db = source.tax_db
+      target.dumpDb()
+
+      # the pickle files are left in place for tools that read them, such as
+      # GPMsDB-tk; they keep the migrated state until export is called
+      with source.writeLock():
+          if source.generation() != generation:
+              for f in [target.db_file, target.db_file + '-wal', target.db_file + '-shm']:
+                  if os.path.exists(f):
+                      os.remove(f)
+              logger.error('The custom db was updated during the migration. Please run migrate_db again.')
+              sys.exit(1)
+
+      logger.info(str(len(source.ribo_db)) + ' entries migrated to ' + target.db_file)
+      logger.info('The pickle files of the custom db are no longer updated; run export_db to bring them up to date for GPMsDB-tk.')
+
+      return target
@@ -20,6 +20,9 @@ class DefaultValues():
         print('Please set this variable to your reference data package.' + '\n')
         sys.exit(1)
 
+    WORK_QUEUE_BATCHES_PER_THREAD = 2
+    SCHEDULE_WINDOW = 10000
+    PROCESS_POLL_INTERVAL = 1     #seconds between checks that worker processes are alive
     NO_THREAD = 4           #number of default threads
 
     GPMsDB_PATH = GENERIC_PATH
@@ -31,12 +34,21 @@ class DefaultValues():
     PRODIGAL_AA = 'genes.faa'
     PRODIGAL_NT = 'genes.fna'
     PRODIGAL_GFF = 'genes.gff'
+    PRODIGAL_AA_MW = 'genes_mw.faa'    #proteins within the mass window
+    TABLE4_MAX_CODING_DENSITY = 0.85    #adaptive mode: table 4 is only tried below this table 11 coding density
+
+    MW_MIN = 2000           #mass window (average MH+) of reported peaks
+    MW_MAX = 15000
 
     E_VAL = 1e-10
     LENGTH = 0.7
     PSEUDOGENE_LENGTH = 0.3
 
     MARKER_GENE_STATS = 'peak_list_genomes.tsv'
+    METRICS_FILE = 'metrics.jsonl'
+    METRICS_SUMMARY_FILE = 'metrics_summary.json'
+    METRICS_STAGES = ['prodigal', 'mw', 'hmmsearch', 'parse']
+    METRICS_SLOWEST_GENOMES = 10
     PFAM_CLAN_FILE = os.path.join(GPMsDB_PATH, 'hmm', 'ribosomal.hmm')
 
     CUSTOM_LIST_R = os.path.join(GPMsDB_PATH, 'custom', 'custom_ribosomals.db')
@@ -44,4 +56,15 @@ class DefaultValues():
     CUSTOM_LIST_GENES = os.path.join(GPMsDB_PATH, 'custom', 'custom_genes.db')
     CUSTOM_LIST_NAME = os.path.join(GPMsDB_PATH, 'custom', 'custom_names.db')
     CUSTOM_LIST_TAX = os.path.join(GPMsDB_PATH, 'custom', 'custom_taxonomy.db')
+    CUSTOM_DB_SQLITE = os.path.join(GPMsDB_PATH, 'custom', 'custom.sqlite')
+    CUSTOM_PEAK_STORE = os.path.join(GPMsDB_PATH, 'custom', 'custom_peaks')
+    CUSTOM_DB_LOCK = os.path.join(GPMsDB_PATH, 'custom', 'custom.lock')
+    CUSTOM_DB_JOURNAL = os.path.join(GPMsDB_PATH, 'custom', 'custom.journal')
+    CUSTOM_DB_GENERATION = os.path.join(GPMsDB_PATH, 'custom', 'custom.generation')
+    CUSTOM_DB_READ_RETRIES = 50
+    PEAK_STORE_DELTA_MIN = 1000        #the peak store is saved in full once more genomes than this
+    PEAK_STORE_DELTA_FRACTION = 0.1    #and than this fraction of it were added or removed since
+
+    QUERY_MASS_PPM = 500
+    IDENTIFY_TOP_K = 10
     
@@ -0,0 +1,236 @@
+#!/usr/bin/env python
+
+__author__ = 'Yuji Sekiguchi'
+__copyright__ = 'Copyright (c) 2023 Yuji Sekiguchi, National Institute of Advanced Industrial Science and Technology (AIST)'
+__credits__ = ['Yuji Sekiguchi']
+__license__ = 'GPL3.0'
+__maintainer__ = 'Yuji Sekiguchi'
+__email__ = 'y.sekiguchi@aist.go.jp'
+__status__ = 'Development'
+
+import os
+import re
+import sys
+import logging
+import multiprocessing as mp
+from collections import namedtuple
+
+import numpy as np
+
+from GPMsDB_dbtk.common import checkFileExists
+from GPMsDB_dbtk.db import openDb
+from GPMsDB_dbtk.defaultValues import DefaultValues
+from GPMsDB_dbtk.peakStore import PeakStore
+
+
+IdentifyResult = namedtuple('IdentifyResult', ['genomeId', 'name', 'taxonomy',
+                                               'matchedRibosomals', 'numRibosomals',
+                                               'matchedOthers', 'numOthers'])
+
+
+class Identify(object):
+    # scores an observed peak list against every genome of the custom db at
+    # once using the sorted mass index of the peak store
+    def __init__(self, store=None):
+        self.logger = logging.getLogger('GPMsDB_tk')
+        if store is None:
+            store = openDb().peakStore()
+        self.store = store
+        self.numRibosomals, self.numOthers = store.peakCounts()
+
+    @staticmethod
+    def readPeakList(peakFile):
+        # first column of a tab, comma or space separated peak list; header
+        # and comment lines are skipped
+        checkFileExists(peakFile)
+
+        peaks = []
+        for line in open(peakFile):
+            element = re.split(r'[\t, ]+', line.strip())
+            try:
+                peaks.append(float(element[0]))
+            except ValueError:
+                continue
+
+        return np.array(peaks, dtype=np.float64)
+
+    def score(self, peaks, ppm=None, da=None):
+        # for each genome, the number of observed peaks matching one of its
+        # ribosomal peaks and the number matching one of its other peaks
+        numGenomes = len(self.store.ids)
+        observed, genomes, _, classes = self.store.matches(peaks, ppm, da)
+        if len(observed) == 0:
+            return np.zeros(numGenomes, dtype=np.int64), np.zeros(numGenomes, dtype=np.int64)
+
+        # an observed peak counts once per genome and class
+        keys = np.unique((observed * numGenomes + genomes) * 2 + classes)
+        genomes = (keys // 2) % numGenomes
+        classes = keys % 2
+
+        matchedRibosomals = np.bincount(genomes[classes == PeakStore.RIBOSOMAL], minlength=numGenomes)
+        matchedOthers = np.bincount(genomes[classes == PeakStore.OTHER], minlength=numGenomes)
+
+        return matchedRibosomals, matchedOthers
+
+    def identify(self, peaks, ppm=None, da=None, topK=DefaultValues.IDENTIFY_TOP_K):
+        # genomes ranked by matched ribosomal peaks, then by the fraction of
+        # their ribosomal peaks matched, then by matched other peaks
+        if ppm is None and da is None:
+            ppm = DefaultValues.QUERY_MASS_PPM
+
+        matchedRibosomals, matchedOthers = self.score(peaks, ppm, da)
+        fraction = matchedRibosomals / np.maximum(self.numRibosomals, 1)
+
+        order = np.lexsort((-matchedOthers, -fraction, -matchedRibosomals))
+        order = order[(matchedRibosomals[order] + matchedOthers[order]) > 0][:topK]
+
+        results = []
+        for i in order:
+            results.append(IdentifyResult(str(self.store.ids[i]), str(self.store.names[i]), str(self.store.taxonomy[i]),
+                                          int(matchedRibosomals[i]), int(self.numRibosomals[i]),
+                                          int(matchedOthers[i]), int(self.numOthers[i])))
+
+        return results
+
+    @staticmethod
+    def resultsHeader():
+        return 'Rank\tGenome Id\tName\tTaxonomy\tMatched ribosomal peaks\t# ribosomal peaks\tMatched other peaks\t# other peaks'
+
+    @staticmethod
+    def resultsRow(rank, result):
+        return '\t'.join([str(rank), result.genomeId, result.name, result.taxonomy,
+                          str(result.matchedRibosomals), str(result.numRibosomals),
+                          str(result.matchedOthers), str(result.numOthers)])
+
+
+class IdentifyBatch(object):
+    # scores many peak lists in parallel; the workers share the peak store
+    # opened by the parent, so all of them score against the same version
+    # even if the db is updated during the run
+    def __init__(self, threads):
+        self.logger = logging.getLogger('GPMsDB_tk')
+        self.totalThreads = threads
+
+    def run(self, peakFiles, outFile, ppm=None, da=None, topK=DefaultValues.IDENTIFY_TOP_K):
+        store = openDb().peakStore()
+
+        self.logger.info("Scoring %d peak lists against %d genomes with %d threads:" % (len(peakFiles), store.numGenomes(), self.totalThreads))
+
+        workerQueue = mp.Queue()
+        writerQueue = mp.Queue()
+
+        # peak lists that could not be read, counted by the workers
+        self.numFailed = mp.Value('i', 0)
+
+        for peakFile in peakFiles:
+            workerQueue.put(peakFile)
+
+        for _ in range(self.totalThreads):
+            workerQueue.put(None)
+
+        calcProc = [mp.Process(target=self.__identifyPeakLists, args=(store, ppm, da, topK, workerQueue, writerQueue)) for _ in range(self.totalThreads)]
+        writeProc = mp.Process(target=self.__reportProcess, args=(len(peakFiles), outFile, writerQueue))
+
+        try:
+            writeProc.start()
+
+            for p in calcProc:
+                p.start()
+
+            # workers can not exit while their results are unread, so the
+            # writer is watched while they finish
+            if not self.__joinWorkers(calcProc, writeProc):
+                self.__stopProcesses(calcProc, writeProc)
+                self.logger.error('The process writing the identification results exited unexpectedly; see the errors above.')
+                sys.exit(1)
+
+            writerQueue.put(None)
+            writeProc.join()
+        except BaseException:
+            self.__stopProcesses(calcProc, writeProc)
+            raise
+
+        if any(p.exitcode != 0 for p in calcProc):
+            self.logger.error('%d of %d scoring processes exited unexpectedly; see the errors above.' % (sum(p.exitcode != 0 for p in calcProc), len(calcProc)))
+            sys.exit(1)
+
+        if writeProc.exitcode != 0:
+            self.logger.error('The process writing the identification results exited unexpectedly; see the errors above.')
+            sys.exit(1)
+
+        if self.numFailed.value > 0:
+            self.logger.error('%d of %d peak lists could not be scored; see the errors above.' % (self.numFailed.value, len(peakFiles)))
+            sys.exit(1)
+
+    def __joinWorkers(self, calcProc, writeProc):
+        for p in calcProc:
+            while p.is_alive():
+                p.join(DefaultValues.PROCESS_POLL_INTERVAL)
+                if p.is_alive() and not writeProc.is_alive():
+                    return False
+
+        return True
+
+    def __stopProcesses(self, calcProc, writeProc):
+        for p in calcProc + [writeProc]:
+            if p.is_alive():
+                p.terminate()
+
+    def __identifyPeakLists(self, store, ppm, da, topK, queueIn, queueOut):
+        # the memory maps of the store are inherited from the parent
+        identify = Identify(store)
+
+        while True:
+            peakFile = queueIn.get(block=True, timeout=None)
+            if peakFile == None:
+                break
+
+            # a peak list that can not be read is reported and skipped so the
+            # rest of the queue is still scored
+            try:
+                peaks = Identify.readPeakList(peakFile)
+            except (OSError, ValueError) as e:
+                self.logger.error('Could not read peak list %s: %s' % (peakFile, e))
+                peaks = None
+            except SystemExit:
+                # checkFileExists has reported the missing file
+                peaks = None
+
+            if peaks is None:
+                with self.numFailed.get_lock():
+                    self.numFailed.value += 1
+                queueOut.put((peakFile, []))
+                continue
+
+            spectrumId = os.path.basename(peakFile)
+            rows = []
+            for rank, result in enumerate(identify.identify(peaks, ppm, da, topK), 1):
+                rows.append(spectrumId + '\t' + Identify.resultsRow(rank, result) + '\n')
+
+            queueOut.put((peakFile, rows))
+
+    def __reportProcess(self, numPeakFiles, outFile, queueIn):
+        numProcessed = 0
+
+        fout = open(outFile, 'w')
+        fout.write('Spectrum\t' + Identify.resultsHeader() + '\n')
+
+        while True:
+            result = queueIn.get(block=True, timeout=None)
+            if result == None:
+                break
+
+            peakFile, rows = result
+            fout.writelines(rows)
+            fout.flush()
+
+            if self.logger.getEffectiveLevel() <= logging.INFO:
+                numProcessed += 1
+                statusStr = '    Finished scoring %d of %d (%.2f%%) peak lists.' % (numProcessed, numPeakFiles, float(numProcessed) * 100 / numPeakFiles)
+                sys.stderr.write('%s\r' % statusStr)
+                sys.stderr.flush()
+
+        fout.close()
+
+        if self.logger.getEffectiveLevel() <= logging.INFO:
+            sys.stderr.write('\n')
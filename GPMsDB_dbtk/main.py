@@ -14,11 +14,14 @@ import logging
 import pickle
 import time
 import ntpath
+import glob
+import itertools
 
-from GPMsDB_dbtk.common import (makeSurePathExists,checkDirExists,checkFileExists)
+from GPMsDB_dbtk.common import (makeSurePathExists,checkDirExists,checkFileExists,genomeIdFromFilename)
 from GPMsDB_dbtk.defaultValues import DefaultValues
 from GPMsDB_dbtk.util.resultsParser import ResultsParser
-from GPMsDB_dbtk.db import Db
+from GPMsDB_dbtk.db import SqliteDb, openDb
+from GPMsDB_dbtk.identify import Identify, IdentifyBatch
 from GPMsDB_dbtk.util.markerGeneFinder import MarkerGeneFinder
 from GPMsDB_dbtk.common import StopWatch,logger_init
 
@@ -29,58 +32,124 @@ class OptionsParser():
         self.logger = logging.getLogger('GPMsDB_tk')
         self.stopwatch = StopWatch(self.logger)
 
-    def binFiles(self, binFolder, binExtension):
-        binFiles = []
-        if binFolder is not None:
-            all_files = os.listdir(binFolder)
-            for f in all_files:
-                if f.endswith(binExtension):
-                    binFile = os.path.join(binFolder, f)
-                    if os.stat(binFile).st_size == 0:
-                        self.logger.warning("Skipping genome %s as it has a size of 0 bytes." % f)
-                    else:
-                        binFiles.append(binFile)
-
-        if not binFiles:
-            self.logger.error("No genomes found. Check the extension (-x) used to identify bins.")
-            sys.exit(1)
+    def binFiles(self, binFolder, binExtension, bRecursive=False, excludeDir=None):
+        # genomes are yielded while the directories are read so that large
+        # collections are never listed or sorted in memory
+        excludeDir = os.path.realpath(excludeDir) if excludeDir else None
+        dirs = [binFolder]
+        # symlinked directories are followed, but each directory is read once
+        # so that a link back to a parent can not make the walk loop
+        visited = set()
+        while dirs:
+            st = os.stat(dirs[-1])
+            if (st.st_dev, st.st_ino) in visited:
+                dirs.pop()
+                continue
+            visited.add((st.st_dev, st.st_ino))
+
+            with os.scandir(dirs.pop()) as entries:
+                for entry in entries:
+                    if entry.is_dir():
+                        if bRecursive and os.path.realpath(entry.path) != excludeDir:
+                            dirs.append(entry.path)
+                    elif entry.name.endswith(binExtension):
+                        if entry.stat().st_size == 0:
+                            self.logger.warning("Skipping genome %s as it has a size of 0 bytes." % entry.name)
+                        else:
+                            yield entry.path
+
+    def manifestBinFiles(self, manifestFile):
+        # genome paths listed one per line; relative paths are taken from the
+        # directory of the manifest
+        checkFileExists(manifestFile)
+        baseDir = os.path.dirname(os.path.abspath(manifestFile))
+        for line in open(manifestFile):
+            if line.strip() == "" or line.startswith('#'):
+                continue
+
+            binFile = os.path.join(baseDir, line.split("\t")[0].strip())
+            if not os.path.isfile(binFile):
+                self.logger.warning("Skipping genome %s as the file does not exist." % binFile)
+            elif os.stat(binFile).st_size == 0:
+                self.logger.warning("Skipping genome %s as it has a size of 0 bytes." % binFile)
+            else:
+                yield binFile
+
+    def uniqueGenomeIds(self, genFiles):
+        # results are written to a directory named by the genome id, so two
+        # genomes with the same file name in different directories would
+        # overwrite each other
+        genIds = {}
+        for genFile in genFiles:
+            genId = genomeIdFromFilename(genFile)
+            if genId in genIds:
+                self.logger.error("Genomes %s and %s have the same id '%s'. Please rename one of them." % (genIds[genId], genFile, genId))
+                sys.exit(1)
+            genIds[genId] = genFile
+            yield genFile
+
+    def translationTables(self, tableFile):
+        translationTables = {}
+        if tableFile is None:
+            return translationTables
+
+        checkFileExists(tableFile)
+        for line in open(tableFile):
+            if line.strip() == "" or line.startswith('#'):
+                continue
+
+            element = line.split("\t")
+            try:
+                translationTable = int(element[1])
+            except (IndexError, ValueError):
+                self.logger.error('Invalid line in translation table file: ' + line.rstrip())
+                sys.exit(1)
 
-        return sorted(binFiles)
+            translationTables[element[0].strip()] = translationTable
+
+        self.logger.info('Translation table set for %d genomes from %s' % (len(translationTables), tableFile))
+
+        return translationTables
 
     def genome_wf(self, options):
         logger_init(self.logger, options.out_dir, silent = options.silent)
         self.logger.info('[genome_wf] Generate peak peaks from a set of genome fasta files.')
 
-        genFiles = self.binFiles(options.gen_dir, options.extension)
+        if options.manifest:
+            genFiles = self.manifestBinFiles(options.gen_dir)
+        else:
+            checkDirExists(options.gen_dir)
+            genFiles = self.binFiles(options.gen_dir, options.extension, options.recursive, options.out_dir)
+
+        genFiles = self.uniqueGenomeIds(genFiles)
+
+        firstGenFile = next(genFiles, None)
+        if firstGenFile is None:
+            self.logger.error("No genomes found. Check the extension (-x) used to identify bins.")
+            sys.exit(1)
+        genFiles = itertools.chain([firstGenFile], genFiles)
 
         makeSurePathExists(options.out_dir)
         checkFileExists(DefaultValues.MARKER_FILE)
 
-        mgf = MarkerGeneFinder(options.threads)
-        binIdToModels = mgf.find(genFiles,
-                                 options.out_dir,
-                                 DefaultValues.HMMER_TABLE_OUT,
-                                 DefaultValues.HMMER_OUT,
-                                 DefaultValues.MARKER_FILE)
-
-        self.logger.info('[genome_wf] Summarizing genome statistics.')
+        translationTables = self.translationTables(options.table_file)
 
-        checkDirExists(options.out_dir)
+        mgf = MarkerGeneFinder(options.threads,
+                               bAdaptiveTable=options.adaptive_table,
+                               translationTables=translationTables,
+                               batchSize=options.batch_size)
+        peakCounts = mgf.find(genFiles,
+                              options.out_dir,
+                              DefaultValues.HMMER_TABLE_OUT,
+                              DefaultValues.HMMER_OUT,
+                              DefaultValues.MARKER_FILE)
 
-        RP = ResultsParser(binIdToModels)
-        RP.analyseResults(options.out_dir,
-                          DefaultValues.HMMER_TABLE_OUT,
-                          bIgnoreThresholds=False,
-                          evalueThreshold=DefaultValues.E_VAL,
-                          lengthThreshold=DefaultValues.LENGTH,
-                          bSkipPseudoGeneCorrection=False,
-                          bSkipAdjCorrection=False
-                          )
+        self.logger.info('[genome_wf] Summarizing genome statistics.')
 
-        RP.printSummary(anaFolder=options.out_dir)
-        markerGenesFile = RP.cacheResults(options.out_dir)
+        RP = ResultsParser(mgf.models)
+        RP.printPeakCounts(peakCounts)
 
-        self.logger.info('Genome peak lists written to: ' + str(markerGenesFile))
+        self.logger.info('Genome peak lists written to: ' + str(mgf.peakListFile))
 
         self.stopwatch.lap()
 
@@ -88,17 +157,47 @@ class OptionsParser():
         logger_init(self.logger, None, silent = options.silent)
         self.logger.info('[db_list] List all custom database entries in db')
 
-        run = Db()
-        run.list()
+        run = openDb()
+        run.list(options.id, options.taxonomy, options.min_peaks, options.max_peaks, options.out_format, options.out_file)
 
         self.stopwatch.lap()
 
+    def peakListFiles(self, paths):
+        # files, glob patterns or directories searched for peak_list_genomes.tsv
+        peakFiles = []
+        for path in paths:
+            if os.path.isdir(path):
+                numFound = len(peakFiles)
+                for root, dirs, files in os.walk(path):
+                    dirs.sort()
+                    if DefaultValues.MARKER_GENE_STATS in files:
+                        peakFiles.append(os.path.join(root, DefaultValues.MARKER_GENE_STATS))
+                if len(peakFiles) == numFound:
+                    self.logger.warning("Skipping %s as no %s was found in it." % (path, DefaultValues.MARKER_GENE_STATS))
+            elif any(c in path for c in '*?['):
+                matches = sorted(glob.glob(path))
+                if not matches:
+                    self.logger.warning("Skipping %s as it matches no file." % path)
+                peakFiles.extend(matches)
+            else:
+                checkFileExists(path)
+                peakFiles.append(path)
+
+        if not peakFiles:
+            self.logger.error("No peak lists found.")
+            sys.exit(1)
+
+        return peakFiles
+
     def update_db(self, options):
         logger_init(self.logger, None, silent = options.silent)
         self.logger.info('[update_db] Add custom genomes into the custom database')
 
-        run = Db()
-        run.add(options.file)
+        peakFiles = self.peakListFiles(options.files)
+        self.logger.info('Reading ' + str(len(peakFiles)) + ' peak lists')
+
+        run = openDb()
+        run.add(peakFiles)
 
         self.stopwatch.lap()
 
@@ -106,11 +205,133 @@ class OptionsParser():
         logger_init(self.logger, None, silent = options.silent)
         self.logger.info('[remove_genome] Remove custom genomes from the custom database')
 
-        run = Db()
+        run = openDb()
         run.remove(options.accessions)
 
         self.stopwatch.lap()
 
+    def query_mass(self, options):
+        logger_init(self.logger, None, silent = options.silent)
+        self.logger.info('[query_mass] Find custom genomes with peaks around the given masses')
+
+        masses = list(options.masses)
+        if options.mass_file is not None:
+            checkFileExists(options.mass_file)
+            for lineNum, line in enumerate(open(options.mass_file), 1):
+                if line.strip() == "" or line.startswith('#'):
+                    continue
+                try:
+                    masses.append(float(line.split("\t")[0]))
+                except ValueError:
+                    self.logger.error('Invalid mass on line %d of %s: %s' % (lineNum, options.mass_file, line.strip()))
+                    sys.exit(1)
+
+        if not masses:
+            self.logger.error('No query mass given.')
+            sys.exit(1)
+
+        run = openDb()
+        hits = run.queryMass(masses, options.ppm, options.da)
+
+        # the matches are data, so they go to stdout even with --silent
+        fout = open(options.out_file, 'w') if options.out_file else sys.stdout
+        fout.write('Query mass\tGenome Id\tPeak mass\tPeak class\tError (ppm)\n')
+        for mass, genomeId, peak, peakClass in hits:
+            fout.write('%.2f\t%s\t%.2f\t%s\t%.1f\n' % (mass, genomeId, peak, peakClass, (peak - mass) / mass * 1e6))
+        if options.out_file:
+            fout.close()
+            self.logger.info('Peaks matching the query masses written to: ' + options.out_file)
+
+        self.logger.info(str(len(hits)) + ' peaks found for ' + str(len(masses)) + ' query masses')
+
+        self.stopwatch.lap()
+
+    def identify(self, options):
+        logger_init(self.logger, None, silent = options.silent)
+        self.logger.info('[identify] Score an observed peak list against the custom database')
+
+        peaks = Identify.readPeakList(options.peak_file)
+        if len(peaks) == 0:
+            self.logger.error('No peaks found in: ' + options.peak_file)
+            sys.exit(1)
+
+        run = Identify()
+        results = run.identify(peaks, options.ppm, options.da, options.top)
+
+        # the ranking is data, so it goes to stdout even with --silent
+        fout = open(options.out_file, 'w') if options.out_file else sys.stdout
+        fout.write(Identify.resultsHeader() + '\n')
+        for rank, result in enumerate(results, 1):
+            fout.write(Identify.resultsRow(rank, result) + '\n')
+        if options.out_file:
+            fout.close()
+            self.logger.info('Identification results written to: ' + options.out_file)
+
+        self.logger.info(str(len(peaks)) + ' observed peaks scored against ' + str(run.store.numGenomes()) + ' genomes')
+
+        self.stopwatch.lap()
+
+    def peakFiles(self, peakDir, peakExtension, manifestFile):
+        peakFiles = []
+        if manifestFile is not None:
+            checkFileExists(manifestFile)
+            for line in open(manifestFile):
+                if line.strip() == "" or line.startswith('#'):
+                    continue
+                peakFile = line.split("\t")[0].strip()
+                if not os.path.isabs(peakFile):
+                    peakFile = os.path.join(os.path.dirname(os.path.abspath(manifestFile)), peakFile)
+                checkFileExists(peakFile)
+                peakFiles.append(peakFile)
+        else:
+            checkDirExists(peakDir)
+            for f in sorted(os.listdir(peakDir)):
+                if f.endswith(peakExtension):
+                    peakFiles.append(os.path.join(peakDir, f))
+
+        if not peakFiles:
+            self.logger.error("No peak lists found. Check the extension (-x) used to identify peak lists.")
+            sys.exit(1)
+
+        return peakFiles
+
+    def identify_batch(self, options):
+        logger_init(self.logger, None, silent = options.silent)
+        self.logger.info('[identify_batch] Score many observed peak lists against the custom database')
+
+        peakFiles = self.peakFiles(options.peak_dir, options.extension, options.manifest)
+
+        run = IdentifyBatch(options.threads)
+        run.run(peakFiles, options.out_file, options.ppm, options.da, options.top)
+
+        self.logger.info('Identification results written to: ' + options.out_file)
+
+        self.stopwatch.lap()
+
+    def migrate_db(self, options):
+        logger_init(self.logger, None, silent = options.silent)
+        self.logger.info('[migrate_db] Migrate the custom database into a single SQLite file')
+
+        if os.path.exists(DefaultValues.CUSTOM_DB_SQLITE):
+            self.logger.error('The custom database has already been migrated: ' + DefaultValues.CUSTOM_DB_SQLITE)
+            sys.exit(1)
+
+        SqliteDb.migrate()
+
+        self.stopwatch.lap()
+
+    def export_db(self, options):
+        logger_init(self.logger, None, silent = options.silent)
+        self.logger.info('[export_db] Write the SQLite custom database back to its pickle files')
+
+        if not os.path.exists(DefaultValues.CUSTOM_DB_SQLITE):
+            self.logger.error('The custom database has not been migrated; its pickle files are already up to date.')
+            sys.exit(1)
+
+        SqliteDb().export()
+
+        self.stopwatch.lap()
+
     def parse_options(self, options):
         if options.subparser_name == 'data':
             self.update_db(options)
@@ -122,6 +343,16 @@ class OptionsParser():
             self.update_db(options)
         elif options.subparser_name == 'remove_genome':
             self.remove_genome(options)
+        elif options.subparser_name == 'migrate_db':
+            self.migrate_db(options)
+        elif options.subparser_name == 'export_db':
+            self.export_db(options)
+        elif options.subparser_name == 'query_mass':
+            self.query_mass(options)
+        elif options.subparser_name == 'identify':
+            self.identify(options)
+        elif options.subparser_name == 'identify_batch':
+            self.identify_batch(options)
         else:
             self.logger.error('Unknown command: ' +
                               options.subparser_name + '\n')
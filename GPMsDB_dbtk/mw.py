@@ -10,108 +10,203 @@ __status__ = 'Development'
 
 import os
 import sys
+import numpy as np
 
 from biolib.seq_io import read_fasta 
 from GPMsDB_dbtk.common import (checkFileExists)
+from GPMsDB_dbtk.defaultValues import DefaultValues
+
+# a list of molecular weights (average) of the basic amino acids
+AA_AVERAGE = {
+    'A' : 71.0788,  # alanine
+    'R' : 156.1875, # arginine
+    'D' : 115.0886, # aspartic acid
+    'N' : 114.1038, # asparagine
+    'C' : 103.1388, # cysteine
+    'E' : 129.1155, # glutamic acid
+    'Q' : 128.1307, # glutamine
+    'G' : 57.0519,  # glycine
+    'H' : 137.1411, # histidine
+    'I' : 113.1594, # isoleucine
+    'L' : 113.1594, # leucine
+    'K' : 128.1741, # lysine
+    'M' : 131.1926, # methionine
+    'F' : 147.1766, # phenylalanine
+    'P' : 97.1167,  # proline
+    'S' : 87.0782,  # serine
+    'T' : 101.1051, # threonine
+    'W' : 186.2132, # tryptophan
+    'Y' : 163.1760, # tyrosine
+    'V' : 99.1326,  # valine
+    'U' : 150.0388, # selenocysteine
+    'O' : 237.3018  # pyrrolysine
+}
+# a list of molecular weights (monoisotopic) of the basic amino acids
+AA_MONOISOTOPIC = {
+    'A' : 71.03711,  # alanine
+    'R' : 156.10111, # arginine
+    'D' : 115.02694, # aspartic acid
+    'N' : 114.04293, # asparagine
+    'C' : 103.00919, # cysteine
+    'E' : 129.04259, # glutamic acid
+    'Q' : 128.05858, # glutamine
+    'G' : 57.02146,  # glycine
+    'H' : 137.05891, # histidine
+    'I' : 113.08406, # isoleucine
+    'L' : 113.08406, # leucine
+    'K' : 128.09496, # lysine
+    'M' : 131.04049, # methionine
+    'F' : 147.06841, # phenylalanine
+    'P' : 97.05276,  # proline
+    'S' : 87.03203,  # serine
+    'T' : 101.04768, # threonine
+    'W' : 186.07931, # tryptophan
+    'Y' : 163.06333, # tyrosine
+    'V' : 99.06841,  # valine
+    'U' : 150.953636, # selenocysteine
+    'O' : 237.147727  # pyrrolysine
+}
+# N-terminal Met is cleaved when followed by one of these residues
+MET_CLEAVAGE = 'GASPVTC'
+
+
+# proteins still being summed when calcMasses finishes them one by one
+MW_SERIAL_PROTEINS = 16
+
+
+def sumInOrder(total, values):
+    for value in values.tolist():
+        total += value
+
+    return total
+
+
+def residueTable(masses):
+    table = np.zeros(256)
+    for aa, mass in masses.items():
+        table[ord(aa)] = mass
+
+    return table
+
 
 class Mw(object):
   def __init__(self):
       self.out_file_name = 'mw.txt'
       self.out_file_name2 = 'mw_s.txt'
+      self.aawa = residueTable(AA_AVERAGE)
+      self.aawm = residueTable(AA_MONOISOTOPIC)
+      self.cleavage = np.zeros(256, dtype=bool)
+      for aa in MET_CLEAVAGE:
+          self.cleavage[ord(aa)] = True
 
-  def run(self, aaFile):
-      aawa = {
-	  	'A' : 71.0788,  # alanine
-	  	'R' : 156.1875, # arginine
-	  	'D' : 115.0886, # aspartic acid
-	  	'N' : 114.1038, # asparagine
-	  	'C' : 103.1388, # cysteine
-	  	'E' : 129.1155, # glutamic acid
-	  	'Q' : 128.1307, # glutamine
-	  	'G' : 57.0519,  # glycine
-	  	'H' : 137.1411, # histidine
-	  	'I' : 113.1594, # isoleucine
-	  	'L' : 113.1594, # leucine
-	  	'K' : 128.1741, # lysine
-	  	'M' : 131.1926, # methionine
-	  	'F' : 147.1766, # phenylalanine
-	  	'P' : 97.1167,  # proline
-	  	'S' : 87.0782,  # serine
-	  	'T' : 101.1051, # threonine
-	  	'W' : 186.2132, # tryptophan
-	  	'Y' : 163.1760, # tyrosine
-	  	'V' : 99.1326,  # valine
-	      'U' : 150.0388, # selenocysteine
-	      'O' : 237.3018 # pyrrolysine
-      }
-      # a list of molecular weights (monoisotopic) of the basic amino acids
-      aawm = {
-	  	'A' : 71.03711,  # alanine
-	  	'R' : 156.10111, # arginine
-	  	'D' : 115.02694, # aspartic acid
-	  	'N' : 114.04293, # asparagine
-	  	'C' : 103.00919, # cysteine
-	  	'E' : 129.04259, # glutamic acid
-	  	'Q' : 128.05858, # glutamine
-	  	'G' : 57.02146,  # glycine
-	  	'H' : 137.05891, # histidine
-	  	'I' : 113.08406, # isoleucine
-	  	'L' : 113.08406, # leucine
-	  	'K' : 128.09496, # lysine
-	  	'M' : 131.04049, # methionine
-	  	'F' : 147.06841, # phenylalanine
-	  	'P' : 97.05276,  # proline
-	  	'S' : 87.03203,  # serine
-	  	'T' : 101.04768, # threonine
-	  	'W' : 186.07931, # tryptophan
-	  	'Y' : 163.06333, # tyrosine
-	  	'V' : 99.06841,  # valine
-	      'U' : 150.953636, # selenocysteine
-	      'O' : 237.147727 # pyrrolysine
-      }
-      checkFileExists(aaFile)
+  def calcMasses(self, seqs):
+      numSeqs = len(seqs)
+      lengths = np.fromiter(map(len, seqs), dtype=np.int64, count=numSeqs)
+      residues = np.frombuffer(''.join(seqs).encode('latin-1'), dtype=np.uint8)
+      offsets = np.zeros(numSeqs, dtype=np.int64)
+      np.cumsum(lengths[:-1], out=offsets[1:])
 
-      file_dir, filename = os.path.split(aaFile)
+      cleaved = np.zeros(numSeqs, dtype=bool)
+      bTwo = lengths > 1
+      cleaved[bTwo] = (residues[offsets[bTwo]] == ord('M')) & self.cleavage[residues[offsets[bTwo] + 1]]
 
-      output_file = os.path.join(file_dir, self.out_file_name)
+      wa = np.where(cleaved, 18.01056+1.00728-131.1926, 18.01056+1.00728)
+      wm = np.where(cleaved, 18.01056+1.00728-131.04049, 18.01056+1.00728)
+
+      # residues are added one position at a time across all proteins, longest
+      # first, so every sum is accumulated in sequence order like a per-protein loop
+      order = np.argsort(-lengths, kind='stable')
+      sortedLengths = lengths[order]
+      sortedOffsets = offsets[order]
+      sortedWa = wa[order]
+      sortedWm = wm[order]
+      residueWa = self.aawa[residues]
+      residueWm = self.aawm[residues]
+
+      # once only a few long proteins are left, each step would add a handful
+      # of residues, so the rest of these proteins is summed one by one in
+      # the same order
+      active = numSeqs
+      maxLength = int(sortedLengths[0]) if numSeqs else 0
+      for pos in range(maxLength):
+          while sortedLengths[active - 1] <= pos:
+              active -= 1
+          if active <= MW_SERIAL_PROTEINS:
+              for i in range(active):
+                  start = sortedOffsets[i] + pos
+                  end = sortedOffsets[i] + sortedLengths[i]
+                  sortedWa[i] = sumInOrder(sortedWa[i], residueWa[start:end])
+                  sortedWm[i] = sumInOrder(sortedWm[i], residueWm[start:end])
+              break
+          idx = sortedOffsets[:active] + pos
+          sortedWa[:active] += residueWa[idx]
+          sortedWm[:active] += residueWm[idx]
+
+      wa[order] = sortedWa
+      wm[order] = sortedWm
+
+      return wa, wm
+
+  def run(self, aaFile, windowAaFile=None):
+      checkFileExists(aaFile)
 
       fasta_sequences = read_fasta(aaFile)
+      wa, wm = self.calcMasses(list(fasta_sequences.values()))
 
-      fout = open(output_file, 'w')
-      fout.write('#Gene Id\taverage MH+\tmonoisotopic MH+\tSequence\n')
-      ms_dic = {}
+      ms_dic = self.__writeMasses(aaFile, fasta_sequences, wa, wm)
+      if windowAaFile:
+          self.writeWindowSeqs(windowAaFile, fasta_sequences, ms_dic)
+
+      return ms_dic
+
+  def writeWindowSeqs(self, windowAaFile, fasta_sequences, ms_dic):
+      # only proteins within the mass window can become peaks
+      numSeqs = 0
+      with open(windowAaFile, 'w') as fout:
+          for k, mass in ms_dic.items():
+              if DefaultValues.MW_MIN < mass < DefaultValues.MW_MAX:
+                  fout.write('>%s\n%s\n' % (k, fasta_sequences[k]))
+                  numSeqs += 1
+
+      return numSeqs
 
-      for k in fasta_sequences.keys():
-      	if fasta_sequences[k][0] == 'M':
-            if fasta_sequences[k][1] == 'G' or fasta_sequences[k][1] == 'A' or fasta_sequences[k][1] == 'S' or fasta_sequences[k][1] == 'P' or fasta_sequences[k][1] == 'V' or fasta_sequences[k][1] == 'T' or fasta_sequences[k][1] == 'C':
-              wa = 18.01056+1.00728-131.1926
-              wm = 18.01056+1.00728-131.04049
-            else:
-              wa = 18.01056+1.00728
-              wm = 18.01056+1.00728
-      	else:
-              wa = 18.01056+1.00728
-              wm = 18.01056+1.00728
-
-      	for aa in fasta_sequences[k]:
-              if aa in aawa:
-              	wa += aawa[aa]
-              if aa in aawm:
-              	wm += aawm[aa]
-
-      	fout.write('%s\t%s\t%s\t%s\n' % (k, wa, wm, fasta_sequences[k]))
-      	ms_dic[k] = wa
-
-      fout.close
+  def runBatch(self, aaFiles):
+      # all proteomes are encoded into one residue buffer and computed together
+      proteomes = []
+      seqs = []
+      for aaFile in aaFiles:
+          checkFileExists(aaFile)
+          fasta_sequences = read_fasta(aaFile)
+          proteomes.append(fasta_sequences)
+          seqs.extend(fasta_sequences.values())
+
+      wa, wm = self.calcMasses(seqs)
+
+      ms_dics = {}
+      start = 0
+      for aaFile, fasta_sequences in zip(aaFiles, proteomes):
+          end = start + len(fasta_sequences)
+          ms_dics[aaFile] = self.__writeMasses(aaFile, fasta_sequences, wa[start:end], wm[start:end])
+          start = end
+
+      return ms_dics
+
+  def __writeMasses(self, aaFile, fasta_sequences, wa, wm):
+      file_dir, filename = os.path.split(aaFile)
+
+      output_file = os.path.join(file_dir, self.out_file_name)
+      ms_dic = {}
+      with open(output_file, 'w') as fout:
+          fout.write('#Gene Id\taverage MH+\tmonoisotopic MH+\tSequence\n')
+          for k, a, m in zip(fasta_sequences.keys(), wa.tolist(), wm.tolist()):
+              fout.write('%s\t%s\t%s\t%s\n' % (k, a, m, fasta_sequences[k]))
+              ms_dic[k] = a
 
       result = sorted(ms_dic.items(), key=lambda x:x[1], reverse=False)
-      key = dict(result)
       output_file2 = os.path.join(file_dir, self.out_file_name2)
-      fout2 = open(output_file2, 'w')
-      for j in key:
-      	if 2000 < ms_dic[j] < 15000:
-      		fout2.write('%s\t%s\n' % (j, ms_dic[j]))
-      	else:
-      	 	continue
+      with open(output_file2, 'w') as fout2:
+          for j, mass in result:
+              if DefaultValues.MW_MIN < mass < DefaultValues.MW_MAX:
+                  fout2.write('%s\t%s\n' % (j, mass))
 
       return ms_dic
@@ -0,0 +1,404 @@
+#!/usr/bin/env python
+
+__author__ = 'Yuji Sekiguchi'
+__copyright__ = 'Copyright (c) 2023 Yuji Sekiguchi, National Institute of Advanced Industrial Science and Technology (AIST)'
+__credits__ = ['Yuji Sekiguchi']
+__license__ = 'GPL3.0'
+__maintainer__ = 'Yuji Sekiguchi'
+__email__ = 'y.sekiguchi@aist.go.jp'
+__status__ = 'Development'
+
+import os
+import json
+import fnmatch
+import shutil
+import uuid
+import numpy as np
+
+from GPMsDB_dbtk.defaultValues import DefaultValues
+
+
+class PeakSegment(object):
+    # peaks of a set of genomes in columnar form: one float array of masses,
+    # genome offsets into it and a class flag per peak, plus the name and
+    # taxonomy of every genome. Per-genome peak counts are kept separately
+    # from the peaks so listing the db never has to read the peaks. The index
+    # arrays hold all peaks sorted by mass with their genome and class for
+    # range queries.
+    ARRAYS = ['ids', 'names', 'taxonomy', 'numRibosomals', 'numOthers', 'offsets', 'masses', 'classes', 'indexMasses', 'indexGenomes', 'indexClasses']
+
+    def __init__(self):
+        self.ids = np.array([], dtype='U1')
+        self.names = np.array([], dtype='U1')
+        self.taxonomy = np.array([], dtype='U1')
+        self.numRibosomals = np.array([], dtype=np.int64)
+        self.numOthers = np.array([], dtype=np.int64)
+        self.offsets = np.zeros(1, dtype=np.int64)
+        self.masses = np.array([], dtype=np.float64)
+        self.classes = np.array([], dtype=np.uint8)
+        self.indexMasses = np.array([], dtype=np.float64)
+        self.indexGenomes = np.array([], dtype=np.int32)
+        self.indexClasses = np.array([], dtype=np.uint8)
+
+    @staticmethod
+    def load(segmentDir):
+        # all arrays are memory-mapped before any is assigned; OSError is
+        # raised if a writer removed the directory in the meantime
+        arrays = {}
+        for name in PeakSegment.ARRAYS:
+            arrays[name] = np.load(os.path.join(segmentDir, name + '.npy'), mmap_mode='r')
+
+        segment = PeakSegment()
+        for name, array in arrays.items():
+            setattr(segment, name, array)
+
+        return segment
+
+    def save(self, segmentDir):
+        os.makedirs(segmentDir)
+        for name in PeakSegment.ARRAYS:
+            np.save(os.path.join(segmentDir, name + '.npy'), np.asarray(getattr(self, name)))
+
+    def numGenomes(self):
+        return len(self.ids)
+
+    def fromDicts(self, ribo_db, others_db, names_db=None, tax_db=None):
+        if names_db is None:
+            names_db = {}
+        if tax_db is None:
+            tax_db = {}
+
+        ids = []
+        offsets = np.zeros(len(ribo_db) + 1, dtype=np.int64)
+        masses = []
+        classes = []
+        for i, (genomeId, ribosomals) in enumerate(ribo_db.items()):
+            ids.append(genomeId)
+            r = PeakStore.parsePeaks(ribosomals)
+            o = PeakStore.parsePeaks(others_db.get(genomeId, []))
+            masses.extend(r)
+            masses.extend(o)
+            classes.extend([PeakStore.RIBOSOMAL] * len(r))
+            classes.extend([PeakStore.OTHER] * len(o))
+            offsets[i + 1] = len(masses)
+
+        self.ids = PeakStore.strArray(ids)
+        self.names = PeakStore.strArray([names_db.get(i, "") for i in ids])
+        self.taxonomy = PeakStore.strArray([tax_db.get(i, "") for i in ids])
+        self.offsets = offsets
+        self.masses = np.array(masses, dtype=np.float64)
+        self.classes = np.array(classes, dtype=np.uint8)
+        self.countPeaks()
+
+    def append(self, other):
+        self.ids = np.concatenate([np.asarray(self.ids), other.ids])
+        self.names = np.concatenate([np.asarray(self.names), other.names])
+        self.taxonomy = np.concatenate([np.asarray(self.taxonomy), other.taxonomy])
+        self.offsets = np.concatenate([np.asarray(self.offsets), np.asarray(other.offsets)[1:] + self.offsets[-1]])
+        self.masses = np.concatenate([np.asarray(self.masses), other.masses])
+        self.classes = np.concatenate([np.asarray(self.classes), other.classes])
+        self.countPeaks()
+
+    def keep(self, keepGenomes):
+        # only the genomes flagged in keepGenomes are kept
+        counts = np.diff(self.offsets)
+        keepPeaks = np.repeat(keepGenomes, counts)
+
+        self.ids = np.asarray(self.ids)[keepGenomes]
+        self.names = np.asarray(self.names)[keepGenomes]
+        self.taxonomy = np.asarray(self.taxonomy)[keepGenomes]
+        self.offsets = np.zeros(len(self.ids) + 1, dtype=np.int64)
+        np.cumsum(counts[keepGenomes], out=self.offsets[1:])
+        self.masses = np.asarray(self.masses)[keepPeaks]
+        self.classes = np.asarray(self.classes)[keepPeaks]
+        self.countPeaks()
+
+    def indicesOf(self, genomeIds):
+        if not genomeIds or len(self.ids) == 0:
+            return np.array([], dtype=np.int64)
+
+        return np.flatnonzero(np.isin(np.asarray(self.ids), list(genomeIds)))
+
+    def countPeaks(self):
+        # number of ribosomal and other peaks of every genome
+        genomeOfPeak = np.repeat(np.arange(len(self.ids)), np.diff(self.offsets))
+        self.numRibosomals = np.bincount(genomeOfPeak[np.asarray(self.classes) == PeakStore.RIBOSOMAL], minlength=len(self.ids))
+        self.numOthers = np.bincount(genomeOfPeak[np.asarray(self.classes) == PeakStore.OTHER], minlength=len(self.ids))
+
+    def buildIndex(self):
+        genomeOfPeak = np.repeat(np.arange(len(self.ids), dtype=np.int32), np.diff(self.offsets))
+        order = np.argsort(self.masses, kind='stable')
+
+        self.indexMasses = np.asarray(self.masses)[order]
+        self.indexGenomes = genomeOfPeak[order]
+        self.indexClasses = np.asarray(self.classes)[order]
+
+    def genomePeaks(self, index):
+        start = self.offsets[index]
+        end = self.offsets[index + 1]
+
+        return self.masses[start:end], self.classes[start:end]
+
+    def peakWindow(self, mass, ppm=None, da=None):
+        # start and end of the peaks within the tolerance of mass (scalar or
+        # array) in the sorted index; an absolute tolerance takes precedence
+        tolerance = da if da is not None else np.asarray(mass) * ppm * 1e-6
+        start = np.searchsorted(self.indexMasses, mass - tolerance, side='left')
+        end = np.searchsorted(self.indexMasses, mass + tolerance, side='right')
+
+        return start, end
+
+    def matches(self, masses, ppm=None, da=None):
+        # every index entry within the tolerance of each mass, with the
+        # position of the mass it matched
+        start, end = self.peakWindow(masses, ppm, da)
+
+        lengths = end - start
+        total = int(lengths.sum())
+        observed = np.repeat(np.arange(len(masses), dtype=np.int64), lengths)
+        positions = np.arange(total, dtype=np.int64) - np.repeat(np.cumsum(lengths) - lengths, lengths) + np.repeat(start, lengths)
+
+        return (observed, np.asarray(self.indexGenomes)[positions].astype(np.int64),
+                np.asarray(self.indexMasses)[positions], np.asarray(self.indexClasses)[positions].astype(np.int64))
+
+
+class PeakStore(object):
+    # peaks of all custom genomes, saved as a base segment written by a full
+    # save plus a delta segment with the genomes added since and the indices
+    # of the base genomes removed since. An update only rewrites the delta;
+    # it is merged into a new base once it outgrows PEAK_STORE_DELTA_FRACTION
+    # of the base. Segments are saved as .npy files in their own directories
+    # so they can be memory-mapped, and the CURRENT file names the base and
+    # delta readers should open. Genomes are numbered base first, then delta;
+    # removed base genomes keep their number but are skipped by all queries.
+    RIBOSOMAL = 0
+    OTHER = 1
+    CLASS_NAMES = ['ribosomal', 'other']
+
+    LOAD_ATTEMPTS = 3
+    NO_DELTA = '-'
+
+    def __init__(self, storeDir):
+        self.storeDir = storeDir
+        self.currentFile = os.path.join(storeDir, 'CURRENT')
+        self.stamp = None
+        self.version = None
+        self.base = PeakSegment()
+        self.delta = PeakSegment()
+        self.removed = np.array([], dtype=np.int64)
+        self.mergeGenomes()
+
+    def load(self, stamp=None):
+        # the segments are opened into locals and only assigned once all of
+        # them are open; if a writer removed a segment named by CURRENT in the
+        # meantime, CURRENT is read again
+        for attempt in range(PeakStore.LOAD_ATTEMPTS):
+            current = self.readCurrent()
+            if current is None:
+                return False
+
+            version, delta, storedStamp = current
+            if stamp is not None and storedStamp != json.loads(json.dumps(stamp)):
+                return False
+
+            try:
+                base = PeakSegment.load(os.path.join(self.storeDir, version))
+                deltaSegment = PeakSegment()
+                removed = np.array([], dtype=np.int64)
+                if delta != PeakStore.NO_DELTA:
+                    deltaSegment = PeakSegment.load(os.path.join(self.storeDir, delta))
+                    removed = np.load(os.path.join(self.storeDir, delta, 'removed.npy'))
+            except OSError:
+                if self.readCurrent() in (None, current):
+                    return False
+                continue
+
+            self.base = base
+            self.delta = deltaSegment
+            self.removed = removed
+            self.version = version
+            self.stamp = storedStamp
+            self.mergeGenomes()
+
+            return True
+
+        return False
+
+    def readCurrent(self):
+        # base version, delta and stamp named by CURRENT, or None; stores
+        # saved before deltas were introduced name only the base
+        try:
+            with open(self.currentFile) as f:
+                fields = f.readline().rstrip('\n').split('\t')
+            if len(fields) == 2:
+                fields.insert(1, PeakStore.NO_DELTA)
+            version, delta, storedStamp = fields
+            return version, delta, json.loads(storedStamp)
+        except (OSError, ValueError):
+            return None
+
+    def save(self, stamp):
+        os.makedirs(self.storeDir, exist_ok=True)
+
+        current = self.readCurrent()
+        previous = current[:2] if current else ()
+
+        if self.version is None or self.bCompact():
+            self.compact()
+            self.version = 'v' + uuid.uuid4().hex
+            self.base.buildIndex()
+            self.base.save(os.path.join(self.storeDir, self.version))
+
+        delta = PeakStore.NO_DELTA
+        if self.delta.numGenomes() > 0 or len(self.removed) > 0:
+            delta = 'd' + uuid.uuid4().hex
+            self.delta.buildIndex()
+            self.delta.save(os.path.join(self.storeDir, delta))
+            np.save(os.path.join(self.storeDir, delta, 'removed.npy'), self.removed)
+
+        tmpFile = self.currentFile + '.' + uuid.uuid4().hex
+        with open(tmpFile, 'w') as f:
+            f.write(self.version + '\t' + delta + '\t' + json.dumps(stamp) + '\n')
+        os.replace(tmpFile, self.currentFile)
+        self.stamp = stamp
+
+        # the segments of the previous CURRENT are kept for readers that read
+        # it just before it was replaced; older ones stay readable only
+        # through memory maps that are already open
+        for d in os.listdir(self.storeDir):
+            path = os.path.join(self.storeDir, d)
+            if d not in (self.version, delta) + previous and os.path.isdir(path):
+                shutil.rmtree(path, ignore_errors=True)
+
+    def bCompact(self):
+        changed = self.delta.numGenomes() + len(self.removed)
+        return changed > max(DefaultValues.PEAK_STORE_DELTA_MIN, DefaultValues.PEAK_STORE_DELTA_FRACTION * self.base.numGenomes())
+
+    def compact(self):
+        # the delta is merged into the base in memory
+        if len(self.removed) > 0:
+            keepGenomes = np.ones(self.base.numGenomes(), dtype=bool)
+            keepGenomes[self.removed] = False
+            self.base.keep(keepGenomes)
+        if self.delta.numGenomes() > 0:
+            self.base.append(self.delta)
+
+        self.delta = PeakSegment()
+        self.removed = np.array([], dtype=np.int64)
+        self.mergeGenomes()
+
+    def mergeGenomes(self):
+        # per-genome arrays of both segments; removed genomes are flagged
+        # rather than dropped so genome numbers stay those of the segments
+        if self.delta.numGenomes() == 0:
+            self.ids = self.base.ids
+            self.names = self.base.names
+            self.taxonomy = self.base.taxonomy
+            self.numRibosomals = self.base.numRibosomals
+            self.numOthers = self.base.numOthers
+        else:
+            self.ids = np.concatenate([np.asarray(self.base.ids), self.delta.ids])
+            self.names = np.concatenate([np.asarray(self.base.names), self.delta.names])
+            self.taxonomy = np.concatenate([np.asarray(self.base.taxonomy), self.delta.taxonomy])
+            self.numRibosomals = np.concatenate([np.asarray(self.base.numRibosomals), self.delta.numRibosomals])
+            self.numOthers = np.concatenate([np.asarray(self.base.numOthers), self.delta.numOthers])
+
+        self.live = np.ones(len(self.ids), dtype=bool)
+        self.live[self.removed] = False
+
+    def buildIndex(self):
+        self.base.buildIndex()
+        self.delta.buildIndex()
+
+    def matches(self, masses, ppm=None, da=None):
+        # every peak of a genome in the store within the tolerance of each of
+        # masses: the position of the matched mass, the genome number, the
+        # peak mass and its class, ordered by matched mass and peak mass
+        masses = np.atleast_1d(np.asarray(masses, dtype=np.float64))
+
+        observed, genomes, peaks, classes = self.base.matches(masses, ppm, da)
+        if self.delta.numGenomes() > 0:
+            deltaMatches = self.delta.matches(masses, ppm, da)
+            observed = np.concatenate([observed, deltaMatches[0]])
+            genomes = np.concatenate([genomes, deltaMatches[1] + self.base.numGenomes()])
+            peaks = np.concatenate([peaks, deltaMatches[2]])
+            classes = np.concatenate([classes, deltaMatches[3]])
+
+            order = np.lexsort((peaks, observed))
+            observed, genomes, peaks, classes = observed[order], genomes[order], peaks[order], classes[order]
+
+        bLive = self.live[genomes]
+        return observed[bLive], genomes[bLive], peaks[bLive], classes[bLive]
+
+    def fromDicts(self, ribo_db, others_db, names_db=None, tax_db=None):
+        # a new base with every genome; it is saved in full
+        self.base = PeakSegment()
+        self.base.fromDicts(ribo_db, others_db, names_db, tax_db)
+        self.delta = PeakSegment()
+        self.removed = np.array([], dtype=np.int64)
+        self.version = None
+        self.mergeGenomes()
+
+    @staticmethod
+    def strArray(values):
+        return np.array(values, dtype=str) if values else np.array([], dtype='U1')
+
+    @staticmethod
+    def parsePeaks(peaks):
+        # peaks are kept as strings in the custom db; empty entries stand for
+        # genomes without peaks of that class
+        return [float(p) for p in peaks if p.strip() != ""]
+
+    def add(self, ribosomals, others, names=None, tax=None):
+        self.remove(ribosomals.keys())
+
+        new = PeakSegment()
+        new.fromDicts(ribosomals, others, names, tax)
+        self.delta.append(new)
+        self.delta.buildIndex()
+        self.mergeGenomes()
+
+    def remove(self, genomeIds):
+        genomeIds = set(genomeIds)
+        if not genomeIds:
+            return
+
+        deltaIndices = self.delta.indicesOf(genomeIds)
+        if len(deltaIndices) > 0:
+            keepGenomes = np.ones(self.delta.numGenomes(), dtype=bool)
+            keepGenomes[deltaIndices] = False
+            self.delta.keep(keepGenomes)
+            self.delta.buildIndex()
+
+        self.removed = np.union1d(self.removed, self.base.indicesOf(genomeIds)).astype(np.int64)
+        self.mergeGenomes()
+
+    def numGenomes(self):
+        return int(self.live.sum())
+
+    def genomePeaks(self, index):
+        if index < self.base.numGenomes():
+            return self.base.genomePeaks(index)
+
+        return self.delta.genomePeaks(index - self.base.numGenomes())
+
+    def peakCounts(self):
+        return self.numRibosomals, self.numOthers
+
+    def select(self, idPattern=None, taxonomy=None, minPeaks=None, maxPeaks=None):
+        # indices of the genomes passing all given filters, in db order
+        bSelected = self.live.copy()
+
+        numPeaks = np.asarray(self.numRibosomals) + np.asarray(self.numOthers)
+        if minPeaks is not None:
+            bSelected &= numPeaks >= minPeaks
+        if maxPeaks is not None:
+            bSelected &= numPeaks <= maxPeaks
+        if taxonomy is not None:
+            bSelected &= np.char.find(np.char.lower(np.asarray(self.taxonomy)), taxonomy.lower()) >= 0
+
+        indices = np.flatnonzero(bSelected)
+        if idPattern is not None:
+            indices = [i for i in indices if fnmatch.fnmatchcase(str(self.ids[i]), idPattern)]
+
+        return indices
@@ -10,143 +10,467 @@ __status__ = 'Development'
 
 import os
 import sys
-import shutil
+import json
+import time
+import heapq
+import queue
+import itertools
 import multiprocessing as mp
 import logging
+import subprocess
 import uuid
-import tempfile
 
 from biolib.external.hmmer import HMMER,HmmModelParser
 
 from GPMsDB_dbtk.util.prodigal import Prodigal
-from GPMsDB_dbtk.common import genomeIdFromFilename, makeSurePathExists
+from GPMsDB_dbtk.util.resultsParser import ResultsParser
+from GPMsDB_dbtk.common import genomeIdFromFilename, makeSurePathExists, StageTimer
 from GPMsDB_dbtk.defaultValues import DefaultValues
 from GPMsDB_dbtk.mw import Mw
 
 
 class MarkerGeneFinder():
-    def __init__(self, threads):
+    def __init__(self, threads, bAdaptiveTable=False, translationTables=None, batchSize=1):
         self.logger = logging.getLogger('GPMsDB_tk')
         self.totalThreads = threads
+        self.bAdaptiveTable = bAdaptiveTable
+        self.translationTables = translationTables if translationTables else {}
+        self.batchSize = max(1, batchSize)
 
     def find(self, genFiles, outDir, tableOut, hmmerOut, markerFile):
         HMMER()
-
-        self.threadsPerSearch = max(1, int(self.totalThreads / len(genFiles)))
-        self.logger.info("Identifying genes in %d seqs with %d threads:" % (len(genFiles), self.totalThreads))
-
-        workerQueue = mp.Queue()
+        startTime = time.time()
+
+        # marker models are parsed once and every search reads the marker file directly
+        self.models = HmmModelParser(markerFile).models()
+
+        # genomes are handed out largest first in batches that share a single
+        # hmmsearch run; the first batches are read up front so that the total
+        # is known for runs no larger than the thread count
+        batches = self.__batches(self.__largestFirst(genFiles))
+        firstBatches = list(itertools.islice(batches, self.totalThreads + 1))
+        numGenomes = sum(len(batch) for batch in firstBatches) if len(firstBatches) <= self.totalThreads else None
+
+        # queued and running batches, used to share the threads between jobs
+        self.jobCounts = mp.Array('i', [len(firstBatches), 0])
+        if numGenomes is not None:
+            self.logger.info("Identifying genes in %d seqs with %d threads:" % (numGenomes, self.totalThreads))
+        else:
+            self.logger.info("Identifying genes with %d threads:" % self.totalThreads)
+        if self.batchSize > 1:
+            self.logger.info("Searching marker genes in batches of up to %d seqs." % self.batchSize)
+
+        self.peakListFile = os.path.join(outDir, DefaultValues.MARKER_GENE_STATS)
+        self.metricsFile = os.path.join(outDir, DefaultValues.METRICS_FILE)
+        self.metricsSummaryFile = os.path.join(outDir, DefaultValues.METRICS_SUMMARY_FILE)
+
+        # the work queue is bounded and filled while the genomes are found, so
+        # memory does not grow with the number of genomes
+        workerQueue = mp.Queue(maxsize=DefaultValues.WORK_QUEUE_BATCHES_PER_THREAD * self.totalThreads)
         writerQueue = mp.Queue()
 
-        for genFile in genFiles:
-            workerQueue.put(genFile)
-
-        for _ in range(self.totalThreads):
-            workerQueue.put(None)
+        # peak counts and the run summary are collected by the writer and
+        # handed back once at the end
+        countsQueue = mp.Queue()
+        peakCounts = {}
+        summary = None
 
-        seqIdToModels = mp.Manager().dict()
+        calcProc = [mp.Process(target=self.__processGenome, args=(outDir, tableOut, markerFile, workerQueue, writerQueue)) for _ in range(self.totalThreads)]
+        writeProc = mp.Process(target=self.__reportProcess, args=(numGenomes, writerQueue, countsQueue))
 
         try:
-            calcProc = [mp.Process(target=self.__processGenome, args=(outDir, tableOut, hmmerOut, markerFile, workerQueue, writerQueue)) for _ in range(self.totalThreads)]
-            writeProc = mp.Process(target=self.__reportProcess, args=(len(genFiles), seqIdToModels, writerQueue))
-
             writeProc.start()
 
             for p in calcProc:
                 p.start()
 
-            for p in calcProc:
-                p.join()
+            if not self.__feedWorkers(workerQueue, firstBatches, batches, calcProc):
+                self.__stopProcesses(calcProc, writeProc)
+                self.logger.error('All gene calling processes exited unexpectedly; see the errors above.')
+                sys.exit(1)
+
+            # workers can not exit while their results are unread, so the
+            # writer is watched while they finish
+            result = None
+            if self.__joinWorkers(calcProc, writeProc):
+                writerQueue.put(None)
+                result = self.__waitForWriter(countsQueue, writeProc)
+
+            if result is None:
+                self.__stopProcesses(calcProc, writeProc)
+                self.logger.error('The process writing the peak lists exited unexpectedly; see the errors above.')
+                sys.exit(1)
 
-            writerQueue.put((None, None))
+            peakCounts, summary = result
             writeProc.join()
-        except:
-            for p in calcProc:
-                p.terminate()
+        except BaseException:
+            # also on a controlled exit raised while the genomes are still
+            # being found, or an interrupt
+            self.__stopProcesses(calcProc, writeProc)
+            raise
+
+        if summary is not None:
+            summary['run_wall_s'] = round(time.time() - startTime, 3)
+            summary['threads'] = self.totalThreads
+            self.__writeSummary(summary)
+
+        return peakCounts
+
+    def __feedWorkers(self, workerQueue, firstBatches, batches, calcProc):
+        # the work queue is bounded, so every put waits for a worker to take a
+        # batch; if all workers have died nothing will ever be taken
+        for batch in firstBatches:
+            if not self.__putWork(workerQueue, batch, calcProc):
+                return False
+
+        for batch in batches:
+            with self.jobCounts.get_lock():
+                self.jobCounts[0] += 1
+            if not self.__putWork(workerQueue, batch, calcProc):
+                return False
+
+        for _ in range(self.totalThreads):
+            if not self.__putWork(workerQueue, None, calcProc):
+                return False
 
-            writeProc.terminate()
+        return True
 
-        d = {}
-        for binId in seqIdToModels.keys():
-            d[binId] = seqIdToModels[binId]
+    def __putWork(self, workerQueue, item, calcProc):
+        while True:
+            try:
+                workerQueue.put(item, timeout=DefaultValues.PROCESS_POLL_INTERVAL)
+                return True
+            except queue.Full:
+                if not any(p.is_alive() for p in calcProc):
+                    return False
+
+    def __joinWorkers(self, calcProc, writeProc):
+        for p in calcProc:
+            while p.is_alive():
+                p.join(DefaultValues.PROCESS_POLL_INTERVAL)
+                if p.is_alive() and not writeProc.is_alive():
+                    return False
+
+        return True
+
+    def __waitForWriter(self, countsQueue, writeProc):
+        # peak counts and summary sent by the writer, or None if it died first
+        while True:
+            try:
+                return countsQueue.get(timeout=DefaultValues.PROCESS_POLL_INTERVAL)
+            except queue.Empty:
+                if not writeProc.is_alive():
+                    break
 
-        return d
+        # the writer may have sent its results just before exiting
+        try:
+            return countsQueue.get(timeout=DefaultValues.PROCESS_POLL_INTERVAL)
+        except queue.Empty:
+            return None
 
-    def __processGenome(self, outDir, tableOut, hmmerOut, markerFile, queueIn, queueOut):
-        markerSetParser = MarkerSetParser(self.threadsPerSearch)
+    def __stopProcesses(self, calcProc, writeProc):
+        for p in calcProc + [writeProc]:
+            if p.is_alive():
+                p.terminate()
 
+    def __writeSummary(self, summary):
+        with open(self.metricsSummaryFile, 'w') as fout:
+            json.dump(summary, fout, indent=2)
+            fout.write('\n')
+
+        self.logger.info('Run time %.1f s for %d genomes (%d bases, %d ORFs).' % (summary['run_wall_s'], summary['genomes'], summary['bases'], summary['orfs']))
+        for stage, metrics in summary['stages'].items():
+            self.logger.info('  %s: %.1f s wall, %.1f s CPU, %.1f s child CPU' % (stage, metrics['wall_s'], metrics['cpu_s'], metrics['child_cpu_s']))
+        self.logger.info('  peak child RSS: %d kB' % summary['child_max_rss_kb'])
+        for genome in summary['slowest_genomes']:
+            self.logger.info('  slow genome %s: %.1f s' % (genome['genome_id'], genome['wall_s']))
+        self.logger.info('Per-genome metrics written to: ' + self.metricsFile)
+
+    def __largestFirst(self, genFiles):
+        # genomes are sorted by file size within windows of the genome stream,
+        # so that the last genomes to finish are small ones
+        genFiles = iter(genFiles)
         while True:
-            binFile = queueIn.get(block=True, timeout=None)
-            if binFile == None:
+            window = list(itertools.islice(genFiles, DefaultValues.SCHEDULE_WINDOW))
+            if not window:
                 break
 
-            binId = genomeIdFromFilename(binFile)
-            binDir = os.path.join(outDir, 'bins', binId)
-            makeSurePathExists(binDir)
+            window.sort(key=os.path.getsize, reverse=True)
+            for genFile in window:
+                yield genFile
 
-            prodigal = Prodigal(binDir)
-            prodigal.run(binFile)
-            aaGeneFile = prodigal.aaGeneFile
+    def __claimThreads(self):
+        # threads are split between the jobs still running or queued: one each
+        # while there is plenty of work, more as the queue drains
+        with self.jobCounts.get_lock():
+            self.jobCounts[0] -= 1
+            self.jobCounts[1] += 1
+            numJobs = min(self.totalThreads, self.jobCounts[0] + self.jobCounts[1])
 
-            hmmModelFile = markerSetParser.createHmmModelFile(binId, markerFile)
+        return max(1, int(self.totalThreads / numJobs))
 
-            hmmer = HMMER()
-            tableOutPath = os.path.join(binDir, tableOut)
-            hmmerOutPath = os.path.join(binDir, hmmerOut)
+    def __releaseThreads(self):
+        with self.jobCounts.get_lock():
+            self.jobCounts[1] -= 1
 
-            keepAlignStr = '--noali'
-            hmmer.search(hmmModelFile, aaGeneFile, tableOutPath, hmmerOutPath,
-                         '--cpu ' + str(self.threadsPerSearch) + ' --notextw -E 0.1 --domE 0.1 ' + keepAlignStr,
-                         False)
+    def __batches(self, genFiles):
+        genFiles = iter(genFiles)
+        while True:
+            batch = list(itertools.islice(genFiles, self.batchSize))
+            if not batch:
+                break
+            yield batch
 
-            M = Mw()
-            ms_dic = M.run(aaGeneFile)
+    def __processGenome(self, outDir, tableOut, markerFile, queueIn, queueOut):
+        resultsParser = ResultsParser(self.models)
+        self.genomeMetrics = {}
 
-            queueOut.put((binId, hmmModelFile))
+        while True:
+            binFiles = queueIn.get(block=True, timeout=None)
+            if binFiles == None:
+                break
 
-    def __reportProcess(self, numGenomes, seqIdToModels, queueIn):
+            self.threadsPerSearch = self.__claimThreads()
+
+            genomes = [self.__callGenes(binFile, outDir) for binFile in binFiles]
+
+            timer = StageTimer()
+            if len(genomes) == 1:
+                binId, binDir, windowAaFile, numProteins = genomes[0]
+                maxRss = self.__searchGenome(markerFile, windowAaFile, numProteins, os.path.join(binDir, tableOut))
+            else:
+                maxRss = self.__searchBatch(markerFile, genomes, outDir, tableOut)
+            searchMetrics = timer.stop()
+            searchMetrics['child_max_rss_kb'] = maxRss
+            searchMetrics['batch_size'] = len(genomes)
+
+            # hits are summarised here so that only the peak lists of each
+            # genome are passed back to be written out
+            for binId, binDir, windowAaFile, numProteins in genomes:
+                timer = StageTimer()
+                genomeResult = resultsParser.parseGenome(outDir, binId, tableOut)
+                resultsParser.releaseGenome(binId)
+
+                # a batched hmmsearch run is reported for each genome in it
+                metrics = self.genomeMetrics.pop(binId)
+                metrics['stages']['hmmsearch'] = searchMetrics
+                metrics['stages']['parse'] = timer.stop()
+                metrics['wall_s'] = round(sum(metrics['stages'][stage]['wall_s'] for stage in DefaultValues.METRICS_STAGES), 3)
+                queueOut.put((genomeResult, metrics))
+
+            self.__releaseThreads()
+
+    def __callGenes(self, binFile, outDir):
+        binId = genomeIdFromFilename(binFile)
+        binDir = os.path.join(outDir, 'bins', binId)
+        makeSurePathExists(binDir)
+
+        timer = StageTimer()
+        prodigal = Prodigal(binDir)
+        translationTable = prodigal.run(binFile,
+                                        threads=self.threadsPerSearch,
+                                        translationTable=self.translationTables.get(binId),
+                                        bAdaptive=self.bAdaptiveTable)
+        aaGeneFile = prodigal.aaGeneFile
+        stages = {'prodigal': timer.stop()}
+        stages['prodigal']['child_max_rss_kb'] = max([m['child_max_rss_kb'] for m in prodigal.tableMetrics.values()] + [0])
+        for table in sorted(prodigal.tableMetrics):
+            stages['prodigal_table%d' % table] = prodigal.tableMetrics[table]
+
+        # masses are calculated first so that only proteins within the
+        # peak mass window are searched against the marker HMMs
+        timer = StageTimer()
+        windowAaFile = os.path.join(binDir, DefaultValues.PRODIGAL_AA_MW)
+        M = Mw()
+        ms_dic = M.run(aaGeneFile, windowAaFile)
+        stages['mw'] = timer.stop()
+
+        self.genomeMetrics[binId] = {'genome_id': binId,
+                                     'genome_file': binFile,
+                                     'bases': prodigal.totalBases,
+                                     'orfs': len(ms_dic),
+                                     'translation_table': translationTable,
+                                     'threads': self.threadsPerSearch,
+                                     'stages': stages}
+
+        return binId, binDir, windowAaFile, len(ms_dic)
+
+    def __hmmsearch(self, markerFile, aaFile, tableOutPath, cmdlineOptions):
+        # run as biolib's HMMER.search does, but waited for with wait4 so the
+        # peak RSS of this run alone is known, as for the Prodigal runs
+        cmd = 'hmmsearch --domtblout %s %s %s %s > /dev/null' % (tableOutPath, cmdlineOptions, markerFile, aaFile)
+        proc = subprocess.Popen(cmd, shell=True)
+        pid, status, usage = os.wait4(proc.pid, 0)
+        proc.returncode = -os.WTERMSIG(status) if os.WIFSIGNALED(status) else os.WEXITSTATUS(status)
+
+        return usage.ru_maxrss
+
+    def __searchGenome(self, markerFile, windowAaFile, numProteins, tableOutPath):
+        if os.path.getsize(windowAaFile) > 0:
+            # -Z keeps E-values on the scale of the full proteome
+            keepAlignStr = '--noali'
+            return self.__hmmsearch(markerFile, windowAaFile, tableOutPath,
+                                    '--cpu ' + str(self.threadsPerSearch) + ' -Z ' + str(numProteins) + ' --notextw -E 0.1 --domE 0.1 ' + keepAlignStr)
+
+        open(tableOutPath, 'w').close()
+        return 0
+
+    def __searchBatch(self, markerFile, genomes, outDir, tableOut):
+        # proteins of all genomes in the batch are searched as one database,
+        # with the genome's position in the batch prefixed to each protein id
+        batchId = str(uuid.uuid4())
+        batchAaFile = os.path.join(outDir, 'bins', batchId + '.faa')
+        batchTableOut = os.path.join(outDir, 'bins', batchId + '.' + tableOut)
+        batchSeqTableOut = os.path.join(outDir, 'bins', batchId + '.seq.' + tableOut)
+
+        with open(batchAaFile, 'w') as fout:
+            for i, (binId, binDir, windowAaFile, numProteins) in enumerate(genomes):
+                for line in open(windowAaFile):
+                    if line[0] == '>':
+                        line = '>%d|%s' % (i, line[1:])
+                    fout.write(line)
+
+        # sequence E-values are rescaled to each genome's own proteome below,
+        # so the reporting threshold is widened to the smallest genome in the
+        # batch. Domains are reported on their conditional E-value, which
+        # hmmsearch scales by domZ, the number of sequences a model reports
+        # in the database searched; --domZ 1 makes it the domain's p-value so
+        # the domZ of each genome can be applied afterwards
+        numProteins = [g[3] for g in genomes]
+        batchProteins = max(1, sum(numProteins))
+        minProteins = max(1, min(numProteins))
+        evalueThreshold = 0.1 * batchProteins / minProteins
+
+        maxRss = 0
+        if os.path.getsize(batchAaFile) > 0:
+            keepAlignStr = '--noali'
+            maxRss = self.__hmmsearch(markerFile, batchAaFile, batchTableOut,
+                                      '--cpu ' + str(self.threadsPerSearch) + ' -Z ' + str(batchProteins) + ' --domZ 1 --notextw -E ' + str(evalueThreshold) + ' --domE 0.1 --tblout ' + batchSeqTableOut + ' ' + keepAlignStr)
+        else:
+            open(batchTableOut, 'w').close()
+            open(batchSeqTableOut, 'w').close()
+
+        MarkerGeneFinder.splitBatchTables(batchTableOut, batchSeqTableOut, numProteins, [os.path.join(g[1], tableOut) for g in genomes])
+
+        for f in [batchAaFile, batchTableOut, batchSeqTableOut]:
+            if os.path.exists(f):
+                os.remove(f)
+
+        return maxRss
+
+    @staticmethod
+    def splitBatchTables(batchTableOut, batchSeqTableOut, numProteins, tableOuts):
+        # the domain table of a batched search is split into the table each
+        # genome's own search would have written with -E 0.1 --domE 0.1:
+        # sequence and independent domain E-values scale with the number of
+        # proteins (-Z), conditional domain E-values with the number of
+        # sequences each model reports in the genome (the default domZ)
+        batchProteins = max(1, sum(numProteins))
+        scales = [float(max(1, n)) / batchProteins for n in numProteins]
+
+        # every reported sequence is in the sequence table, including those
+        # without a reported domain
+        domZ = {}
+        for line in open(batchSeqTableOut):
+            if line[0] == '#' or line.strip() == '':
+                continue
+
+            lineSplit = line.split(None, 5)
+            index = int(lineSplit[0].split('|', 1)[0])
+            if float(lineSplit[4]) * scales[index] <= 0.1:
+                key = (index, lineSplit[2])
+                domZ[key] = domZ.get(key, 0) + 1
+
+        fouts = [open(f, 'w') for f in tableOuts]
+        for line in open(batchTableOut):
+            if line[0] == '#' or line.strip() == '':
+                continue
+
+            lineSplit = line.rstrip('\n').split(None, 22)
+            index, targetName = lineSplit[0].split('|', 1)
+            index = int(index)
+
+            fullEvalue = float(lineSplit[6]) * scales[index]
+            if fullEvalue > 0.1:
+                continue
+
+            # the batch was searched with --domZ 1
+            condEvalue = float(lineSplit[11]) * domZ[(index, lineSplit[3])]
+            if condEvalue > 0.1:
+                continue
+
+            lineSplit[0] = targetName
+            lineSplit[6] = '%.2g' % fullEvalue
+            lineSplit[11] = '%.2g' % condEvalue
+            lineSplit[12] = '%.2g' % (float(lineSplit[12]) * scales[index])
+            fouts[index].write(' '.join(lineSplit) + '\n')
+
+        for fout in fouts:
+            fout.close()
+
+    def __reportProcess(self, numGenomes, queueIn, queueCounts):
         numProcessedGenomes = 0
+        peakCounts = {}
+        summary = {'genomes': 0, 'bases': 0, 'orfs': 0, 'child_max_rss_kb': 0,
+                   'stages': dict((stage, {'wall_s': 0.0, 'cpu_s': 0.0, 'child_cpu_s': 0.0}) for stage in DefaultValues.METRICS_STAGES)}
+        slowestGenomes = []
         if self.logger.getEffectiveLevel() <= logging.INFO:
-            statusStr = '    Finished processing %d of %d (%.2f%%) seqs.' % (numProcessedGenomes, numGenomes, float(numProcessedGenomes) * 100 / numGenomes)
-            sys.stderr.write('%s\r' % statusStr)
+            sys.stderr.write('%s\r' % self.__statusStr(numProcessedGenomes, numGenomes))
             sys.stderr.flush()
 
+        fout = open(self.peakListFile, 'w')
+        fout.write(ResultsParser.peakListHeader())
+        foutMetrics = open(self.metricsFile, 'w')
+
         while True:
-            binId, hmmModelFile = queueIn.get(block=True, timeout=None)
-            if binId == None:
+            result = queueIn.get(block=True, timeout=None)
+            if result == None:
                 break
 
-            modelParser = HmmModelParser(hmmModelFile)
-            models = modelParser.models()
+            genomeResult, metrics = result
+            fout.write(ResultsParser.peakListRow(genomeResult.binId, genomeResult.genesRibosomals, genomeResult.genesOthers))
+            fout.flush()
+            foutMetrics.write(json.dumps(metrics) + '\n')
+            foutMetrics.flush()
 
-            seqIdToModels[binId] = models
-
-            if os.path.exists(hmmModelFile):
-                os.remove(hmmModelFile)
-
-            indexFile = hmmModelFile + '.ssi'
-            if os.path.exists(indexFile):
-                os.remove(indexFile)
+            peakCounts[genomeResult.binId] = (len(genomeResult.genesRibosomals), len(genomeResult.genesOthers))
+            self.__addToSummary(summary, slowestGenomes, metrics)
 
             if self.logger.getEffectiveLevel() <= logging.INFO:
                 numProcessedGenomes += 1
-                statusStr = '    Finished processing %d of %d (%.2f%%) seqs.' % (numProcessedGenomes, numGenomes, float(numProcessedGenomes) * 100 / numGenomes)
-                sys.stderr.write('%s\r' % statusStr)
+                sys.stderr.write('%s\r' % self.__statusStr(numProcessedGenomes, numGenomes))
                 sys.stderr.flush()
 
-        if self.logger.getEffectiveLevel() <= logging.INFO:
-            sys.stderr.write('\n')
-            
-            
-            
-class MarkerSetParser():
-    def __init__(self, threads=1):
-        self.logger = logging.getLogger('GPMsDB_tk')
-        self.numThreads = threads
+        fout.close()
+        foutMetrics.close()
 
-    def createHmmModelFile(self, binId, markerFile):
-        hmmModelFile = os.path.join(tempfile.gettempdir(), str(uuid.uuid4()))
-        shutil.copyfile(markerFile, hmmModelFile)
+        summary['slowest_genomes'] = [{'genome_id': binId, 'wall_s': wall} for wall, binId in sorted(slowestGenomes, reverse=True)]
+        queueCounts.put((peakCounts, summary))
 
-        return hmmModelFile
+        if self.logger.getEffectiveLevel() <= logging.INFO:
+            sys.stderr.write('\n')
 
+    def __addToSummary(self, summary, slowestGenomes, metrics):
+        summary['genomes'] += 1
+        summary['bases'] += metrics['bases']
+        summary['orfs'] += metrics['orfs']
+
+        # a batched hmmsearch run is split evenly between its genomes so
+        # that the run is only counted once
+        for stage in DefaultValues.METRICS_STAGES:
+            stageMetrics = metrics['stages'][stage]
+            share = 1.0 / stageMetrics.get('batch_size', 1)
+            for key in ['wall_s', 'cpu_s', 'child_cpu_s']:
+                summary['stages'][stage][key] = round(summary['stages'][stage][key] + share * stageMetrics[key], 3)
+            summary['child_max_rss_kb'] = max(summary['child_max_rss_kb'], stageMetrics.get('child_max_rss_kb', 0))
+
+        heapq.heappush(slowestGenomes, (metrics['wall_s'], metrics['genome_id']))
+        if len(slowestGenomes) > DefaultValues.METRICS_SLOWEST_GENOMES:
+            heapq.heappop(slowestGenomes)
+
+    def __statusStr(self, numProcessedGenomes, numGenomes):
+        # the total is only known up front for runs no larger than the thread count
+        if numGenomes is None:
+            return '    Finished processing %d seqs.' % numProcessedGenomes
+
+        return '    Finished processing %d of %d (%.2f%%) seqs.' % (numProcessedGenomes, numGenomes, float(numProcessedGenomes) * 100 / numGenomes)
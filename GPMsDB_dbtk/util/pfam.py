@@ -9,21 +9,78 @@ __email__ = 'y.sekiguchi@aist.go.jp'
 __status__ = 'Development'
 
 
+import os
+import pickle
+import tempfile
+from bisect import bisect_left, bisect_right
 from collections import defaultdict
 
 from GPMsDB_dbtk.common import checkFileExists
 
 
 class PFAM(object):
+    # clan and nesting data are parsed once per process for each clan file
+    clanCache = {}
+
     def __init__(self, pfamClanFile):
         self.pfamClanFile = pfamClanFile
         self.idToAcc = {}  
         self.clan = {}  
         self.nested = {} 
+        self.bClansRead = False
 
     def __readClansAndNesting(self):
+        if self.bClansRead:
+            return
+
+        if self.pfamClanFile not in PFAM.clanCache:
+            PFAM.clanCache[self.pfamClanFile] = self.__loadClanIndex()
+
+        self.idToAcc, self.clan, self.nested = PFAM.clanCache[self.pfamClanFile]
+        self.bClansRead = True
+
+    def __loadClanIndex(self):
         checkFileExists(self.pfamClanFile)
 
+        # a precompiled index next to the clan file is used while it is newer
+        # than the clan file itself
+        indexFile = self.pfamClanFile + '.clans.pkl'
+        stat = os.stat(self.pfamClanFile)
+        stamp = (stat.st_mtime_ns, stat.st_size)
+        try:
+            with open(indexFile, 'rb') as f:
+                index = pickle.load(f)
+            if index['stamp'] == stamp:
+                return index['idToAcc'], index['clan'], index['nested']
+        except Exception:
+            # a missing, truncated or foreign index is rebuilt
+            pass
+
+        idToAcc, clan, nested = self.__parseClansAndNesting()
+
+        # the index is written to a temporary file and renamed into place so
+        # concurrent runs never read a partial index; a clan file in a
+        # read-only directory is simply parsed every time
+        tmpFile = None
+        try:
+            fd, tmpFile = tempfile.mkstemp(prefix=os.path.basename(indexFile) + '.', dir=os.path.dirname(os.path.abspath(indexFile)))
+            with os.fdopen(fd, 'wb') as f:
+                pickle.dump({'stamp': stamp, 'idToAcc': idToAcc, 'clan': clan, 'nested': nested}, f)
+            os.replace(tmpFile, indexFile)
+        except Exception:
+            if tmpFile and os.path.exists(tmpFile):
+                try:
+                    os.remove(tmpFile)
+                except OSError:
+                    pass
+
+        return idToAcc, clan, nested
+
+    def __parseClansAndNesting(self):
+        idToAcc = {}
+        clan = {}
+        nested = {}
+
         idNested = defaultdict(list)
         for line in open(self.pfamClanFile):
             if '#=GF ID' in line:
@@ -31,18 +88,20 @@ class PFAM(object):
             elif '#=GF AC' in line:
                 pfamAcc = line.split()[2].strip()
                 pfamAcc = pfamAcc[0:pfamAcc.rfind('.')]
-                self.idToAcc[ID] = pfamAcc
+                idToAcc[ID] = pfamAcc
             elif '#=GF CL' in line:
                 clanId = line.split()[2].strip()
-                self.clan[pfamAcc] = clanId
+                clan[pfamAcc] = clanId
             elif '#=GF NE' in line:
                 nestedId = line.split()[2].strip()
                 idNested[nestedId].append(ID)
                 idNested[ID].append(nestedId)
 
-        for ID, nested in idNested.items():
-            pfamAcc = self.idToAcc[ID]
-            self.nested[pfamAcc] = set([self.idToAcc[x] for x in nested])
+        for ID, nestedIds in idNested.items():
+            pfamAcc = idToAcc[ID]
+            nested[pfamAcc] = set([idToAcc[x] for x in nestedIds])
+
+        return idToAcc, clan, nested
 
     def pfamIdToClanId(self):
         checkFileExists(self.pfamClanFile)
@@ -71,8 +130,7 @@ class PFAM(object):
         return d
 
     def filterHitsFromSameClan(self, markerHits):
-        if len(self.clan) == 0:
-            self.__readClansAndNesting()
+        self.__readClansAndNesting()
 
         filteredMarkers = defaultdict(list)
         hitsToORFs = defaultdict(list)
@@ -86,37 +144,40 @@ class PFAM(object):
         for target_name, hits in hitsToORFs.items():
             hits.sort(key=lambda x: (x.full_e_value, x.i_evalue))
 
-            filtered = set()
-            for i in range(0, len(hits)):
-                if i in filtered:
+            # hits are visited best first and dropped when they overlap a kept
+            # hit from the same clan that is not nested with them. Kept hits are
+            # indexed by start within each clan, so only those whose span can
+            # reach the current hit are compared.
+            keptStarts = defaultdict(list)
+            keptHits = defaultdict(list)
+            maxSpan = defaultdict(int)
+            for hit in hits:
+                pfamIdJ = hit.query_accession
+                pfamIdJ = pfamIdJ[0:pfamIdJ.rfind('.')]
+                clanJ = self.clan.get(pfamIdJ, None)
+                startJ = hit.ali_from
+                endJ = hit.ali_to
+
+                starts = keptStarts[clanJ]
+                lo = bisect_left(starts, min(startJ - maxSpan[clanJ] + 1, startJ))
+                hi = bisect_right(starts, max(startJ, endJ - 1))
+
+                bFiltered = False
+                for startI, endI, pfamIdI in keptHits[clanJ][lo:hi]:
+                    if (startI <= startJ and endI > startJ) or (startJ <= startI and endJ > startI):
+                        if not (pfamIdI in self.nested and pfamIdJ in self.nested[pfamIdI]):
+                            bFiltered = True
+                            break
+
+                if bFiltered:
                     continue
 
-                pfamIdI = hits[i].query_accession
-                pfamIdI = pfamIdI[0:pfamIdI.rfind('.')]
-                clanI = self.clan.get(pfamIdI, None)
-                startI = hits[i].ali_from
-                endI = hits[i].ali_to
-
-                for j in range(i + 1, len(hits)):
-                    if j in filtered:
-                        continue
-
-                    pfamIdJ = hits[j].query_accession
-                    pfamIdJ = pfamIdJ[0:pfamIdJ.rfind('.')]
-                    clanJ = self.clan.get(pfamIdJ, None)
-                    startJ = hits[j].ali_from
-                    endJ = hits[j].ali_to
-
-                    if pfamIdI != None and pfamIdJ != None and clanI == clanJ:
-                        if (startI <= startJ and endI > startJ) or (startJ <= startI and endJ > startI):
-                            if not (pfamIdI in self.nested and pfamIdJ in self.nested[pfamIdI]):
-                                filtered.add(j)
-
-            for i in range(0, len(hits)):
-                if i in filtered:
-                    continue
+                pos = bisect_right(starts, startJ)
+                starts.insert(pos, startJ)
+                keptHits[clanJ].insert(pos, (startJ, endJ, pfamIdJ))
+                maxSpan[clanJ] = max(maxSpan[clanJ], endJ - startJ)
 
-                filteredMarkers[hits[i].query_accession].append(hits[i])
+                filteredMarkers[hit.query_accession].append(hit)
 
         return filteredMarkers
 
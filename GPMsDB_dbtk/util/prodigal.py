@@ -15,12 +15,12 @@ import stat
 import subprocess
 import logging
 import shutil
-import numpy as np
-
-from biolib.seq_io import read_fasta, write_fasta
+import threading
+import time
+from bisect import bisect_right
 
 from GPMsDB_dbtk.defaultValues import DefaultValues
-from GPMsDB_dbtk.common import checkFileExists
+from GPMsDB_dbtk.common import checkFileExists, fastaSeqLengths, openSeqFile
 
 
 class ProdigalError(BaseException):
@@ -35,55 +35,79 @@ class Prodigal():
         self.ntGeneFile = os.path.join(outDir, DefaultValues.PRODIGAL_NT)
         self.gffFile = os.path.join(outDir, DefaultValues.PRODIGAL_GFF)
 
-    def run(self, query, bNucORFs=True):
+    def run(self, query, bNucORFs=True, threads=1, translationTable=None, bAdaptive=False):
 
-        prodigal_input = query
+        seqLens = fastaSeqLengths(query)
+        totalBases = sum(seqLens.values())
+        self.totalBases = totalBases
 
-        if prodigal_input.endswith('.gz'):
-            tmp_dir = tempfile.mkdtemp()
-            prodigal_input = os.path.join(tmp_dir, os.path.basename(prodigal_input[0:-3]) + '.fna')
-            writeFasta(seqs, prodigal_input)
+        # wall time and resources of the Prodigal runs of each table
+        self.tableMetrics = {}
 
-        seqs = read_fasta(prodigal_input)
-        totalBases = 0
-        for seqId, seq in seqs.items():
-            totalBases += len(seq)
+        if totalBases < 100000:
+            procedureStr = 'meta'  
+        else:
+            procedureStr = 'single'  
 
-        tableCodingDensity = {}
-        for translationTable in [4, 11]:
-            aaGeneFile = self.aaGeneFile + '.' + str(translationTable)
-            ntGeneFile = self.ntGeneFile + '.' + str(translationTable)
-            gffFile = self.gffFile + '.' + str(translationTable)
+        # both translation tables are independent Prodigal runs, so they can
+        # share the CPU budget of this genome when more than one is available
+        bConcurrent = threads > 1
 
-            if totalBases < 100000:
-                procedureStr = 'meta'  
-            else:
-                procedureStr = 'single'  
+        if translationTable:
+            translationTables = [translationTable]
+        elif bAdaptive:
+            translationTables = [11]
+        else:
+            translationTables = [4, 11]
 
+        tableCodingDensity = self.__callGenes(translationTables, query, procedureStr, bNucORFs, bConcurrent, seqLens, totalBases)
+
+        # table 4 is only selected when it clearly improves on table 11, which
+        # requires a table 11 coding density typical of recoded genomes
+        if bAdaptive and not translationTable and tableCodingDensity[11] < DefaultValues.TABLE4_MAX_CODING_DENSITY:
+            translationTables.append(4)
+            tableCodingDensity.update(self.__callGenes([4], query, procedureStr, bNucORFs, bConcurrent, seqLens, totalBases))
+
+        if translationTable:
+            bestTranslationTable = translationTable
+        else:
+            bestTranslationTable = 11
+            if 4 in tableCodingDensity and (tableCodingDensity[4] - tableCodingDensity[11] > 0.05) and tableCodingDensity[4] > 0.7:
+                bestTranslationTable = 4
+
+        shutil.copyfile(self.aaGeneFile + '.' + str(bestTranslationTable), self.aaGeneFile)
+        shutil.copyfile(self.gffFile + '.' + str(bestTranslationTable), self.gffFile)
+        if bNucORFs:
+            shutil.copyfile(self.ntGeneFile + '.' + str(bestTranslationTable), self.ntGeneFile)
+
+        for table in translationTables:
+            os.remove(self.aaGeneFile + '.' + str(table))
+            os.remove(self.gffFile + '.' + str(table))
             if bNucORFs:
-                cmd = ('prodigal -p %s -q -m -f gff -g %d -a %s -d %s -i %s > %s 2> /dev/null' % (procedureStr,
-                                                                                                    translationTable,
-                                                                                                    aaGeneFile,
-                                                                                                    ntGeneFile,
-                                                                                                    prodigal_input,
-                                                                                                    gffFile))
-            else:
-                cmd = ('prodigal -p %s -q -m -f gff -g %d -a %s -i %s > %s 2> /dev/null' % (procedureStr,
-                                                                                            translationTable,
-                                                                                            aaGeneFile,
-                                                                                            prodigal_input,
-                                                                                            gffFile))
+                os.remove(self.ntGeneFile + '.' + str(table))
 
-            os.system(cmd)
+        return bestTranslationTable
 
+    def __callGenes(self, translationTables, query, procedureStr, bNucORFs, bConcurrent, seqLens, totalBases):
+        cmds = {}
+        for translationTable in translationTables:
+            cmds[translationTable] = self.__prodigalCmd(translationTable, procedureStr, query, bNucORFs)
+        self.__runProdigal(cmds, query, bConcurrent)
+
+        retryCmds = {}
+        for translationTable, cmd in cmds.items():
+            aaGeneFile = self.aaGeneFile + '.' + str(translationTable)
             if not self.__areORFsCalled(aaGeneFile) and procedureStr == 'single':
-                cmd = cmd.replace('-p single', '-p meta')
-                os.system(cmd)
+                retryCmds[translationTable] = cmd.replace('-p single', '-p meta')
+        self.__runProdigal(retryCmds, query, bConcurrent)
 
+        tableCodingDensity = {}
+        for translationTable in translationTables:
+            gffFile = self.gffFile + '.' + str(translationTable)
             prodigalParser = ProdigalGeneFeatureParser(gffFile)
 
             codingBases = 0
-            for seqId, seq in seqs.items():
+            for seqId in seqLens:
                 codingBases += prodigalParser.codingBases(seqId)
 
             if totalBases != 0:
@@ -92,25 +116,83 @@ class Prodigal():
                 codingDensity = 0
             tableCodingDensity[translationTable] = codingDensity
 
-        bestTranslationTable = 11
-        if (tableCodingDensity[4] - tableCodingDensity[11] > 0.05) and tableCodingDensity[4] > 0.7:
-            bestTranslationTable = 4
+        return tableCodingDensity
+
+    def __prodigalCmd(self, translationTable, procedureStr, query, bNucORFs):
+        aaGeneFile = self.aaGeneFile + '.' + str(translationTable)
+        ntGeneFile = self.ntGeneFile + '.' + str(translationTable)
+        gffFile = self.gffFile + '.' + str(translationTable)
+
+        # compressed genomes are streamed into Prodigal's stdin rather than
+        # being decompressed to a temporary file
+        if query.endswith('.gz'):
+            inputStr = ''
+        else:
+            inputStr = '-i %s' % query
 
-        shutil.copyfile(self.aaGeneFile + '.' + str(bestTranslationTable), self.aaGeneFile)
-        shutil.copyfile(self.gffFile + '.' + str(bestTranslationTable), self.gffFile)
         if bNucORFs:
-            shutil.copyfile(self.ntGeneFile + '.' + str(bestTranslationTable), self.ntGeneFile)
+            cmd = ('prodigal -p %s -q -m -f gff -g %d -a %s -d %s %s > %s 2> /dev/null' % (procedureStr,
+                                                                                             translationTable,
+                                                                                             aaGeneFile,
+                                                                                             ntGeneFile,
+                                                                                             inputStr,
+                                                                                             gffFile))
+        else:
+            cmd = ('prodigal -p %s -q -m -f gff -g %d -a %s %s > %s 2> /dev/null' % (procedureStr,
+                                                                                     translationTable,
+                                                                                     aaGeneFile,
+                                                                                     inputStr,
+                                                                                     gffFile))
+
+        return cmd
+
+    def __runProdigal(self, cmds, query, bConcurrent):
+        bStream = query.endswith('.gz')
+
+        procs = []
+        for translationTable in sorted(cmds):
+            startTime = time.time()
+            if bStream:
+                proc = subprocess.Popen(cmds[translationTable], shell=True, stdin=subprocess.PIPE)
+                feeder = threading.Thread(target=self.__feedProdigal, args=(query, proc))
+                feeder.start()
+            else:
+                proc = subprocess.Popen(cmds[translationTable], shell=True)
+                feeder = None
 
-        for translationTable in [4, 11]:
-            os.remove(self.aaGeneFile + '.' + str(translationTable))
-            os.remove(self.gffFile + '.' + str(translationTable))
-            if bNucORFs:
-                os.remove(self.ntGeneFile + '.' + str(translationTable))
+            if bConcurrent:
+                procs.append((translationTable, startTime, proc, feeder))
+            else:
+                self.__waitProdigal(translationTable, startTime, proc, feeder)
 
-        if prodigal_input.endswith('.gz'):
-            shutil.rmtree(tmp_dir)
+        for translationTable, startTime, proc, feeder in procs:
+            self.__waitProdigal(translationTable, startTime, proc, feeder)
 
-        return bestTranslationTable
+    def __feedProdigal(self, query, proc):
+        try:
+            with openSeqFile(query) as f:
+                shutil.copyfileobj(f, proc.stdin, 1024 * 1024)
+        except BrokenPipeError:
+            pass
+        finally:
+            try:
+                proc.stdin.close()
+            except BrokenPipeError:
+                pass
+
+    def __waitProdigal(self, translationTable, startTime, proc, feeder):
+        if feeder:
+            feeder.join()
+
+        # wait4 reports the resources of this run alone, including Prodigal
+        # itself below the shell; a retry in meta mode adds to the first run
+        pid, status, usage = os.wait4(proc.pid, 0)
+        proc.returncode = -os.WTERMSIG(status) if os.WIFSIGNALED(status) else os.WEXITSTATUS(status)
+
+        metrics = self.tableMetrics.setdefault(translationTable, {'wall_s': 0.0, 'child_cpu_s': 0.0, 'child_max_rss_kb': 0})
+        metrics['wall_s'] = round(metrics['wall_s'] + time.time() - startTime, 3)
+        metrics['child_cpu_s'] = round(metrics['child_cpu_s'] + usage.ru_utime + usage.ru_stime, 3)
+        metrics['child_max_rss_kb'] = max(metrics['child_max_rss_kb'], usage.ru_maxrss)
 
     def __areORFsCalled(self, aaGeneFile):
         return os.path.exists(aaGeneFile) and os.stat(aaGeneFile)[stat.ST_SIZE] != 0
@@ -159,9 +241,13 @@ class ProdigalGeneFeatureParser():
 
         self.__parseGFF(filename)
 
-        self.codingBaseMasks = {}
+        # coding bases are tracked as merged intervals rather than per-base
+        # masks so memory scales with the number of genes, not contig length
+        self.codingStarts = {}
+        self.codingEnds = {}
+        self.codingPrefix = {}
         for seqId in self.genes:
-            self.codingBaseMasks[seqId] = self.__buildCodingBaseMask(seqId)
+            self.__mergeCodingIntervals(seqId)
 
     def __parseGFF(self, filename):
         self.translationTable = None
@@ -191,18 +277,46 @@ class ProdigalGeneFeatureParser():
             self.genes[seqId][geneId] = [start, end]
             self.lastCodingBase[seqId] = max(self.lastCodingBase[seqId], end)
 
-    def __buildCodingBaseMask(self, seqId):
-        codingBaseMask = np.zeros(self.lastCodingBase[seqId])
-        for pos in self.genes[seqId].values():
-            codingBaseMask[pos[0]:pos[1] + 1] = 1
+    def __mergeCodingIntervals(self, seqId):
+        # half-open intervals [start, end + 1) clipped to the last coding base,
+        # matching the positions a mask of that length would cover
+        lastCodingBase = self.lastCodingBase[seqId]
 
-        return codingBaseMask
+        starts = []
+        ends = []
+        for start, end in sorted(self.genes[seqId].values()):
+            end = min(end + 1, lastCodingBase)
+            if start >= end:
+                continue
+
+            if starts and start <= ends[-1]:
+                ends[-1] = max(ends[-1], end)
+            else:
+                starts.append(start)
+                ends.append(end)
+
+        prefix = [0]
+        for start, end in zip(starts, ends):
+            prefix.append(prefix[-1] + end - start)
+
+        self.codingStarts[seqId] = starts
+        self.codingEnds[seqId] = ends
+        self.codingPrefix[seqId] = prefix
+
+    def __codingBasesBefore(self, seqId, pos):
+        starts = self.codingStarts[seqId]
+        i = bisect_right(starts, pos) - 1
+        if i < 0:
+            return 0
+
+        return self.codingPrefix[seqId][i] + min(self.codingEnds[seqId][i], pos) - starts[i]
 
     def codingBases(self, seqId, start=0, end=None):
         if seqId not in self.genes:
             return 0
 
-        if end == None:
-            end = self.lastCodingBase[seqId]
+        start, end, _ = slice(start, end).indices(self.lastCodingBase[seqId])
+        if start >= end:
+            return 0
 
-        return np.sum(self.codingBaseMasks[seqId][start:end])
+        return self.__codingBasesBefore(seqId, end) - self.__codingBasesBefore(seqId, start)
@@ -15,25 +15,25 @@ import ast
 from collections import defaultdict
 import logging
 
-from biolib.external.hmmer import HMMERParser
-
 from GPMsDB_dbtk.defaultValues import DefaultValues
 from GPMsDB_dbtk.common import checkFileExists
 from GPMsDB_dbtk.util.pfam import PFAM
 
 
 class ResultsParser():
-    def __init__(self, binIdToModels):
+    def __init__(self, models):
         self.logger = logging.getLogger('GPMsDB_tk')
         self.results = {}
-        self.models = binIdToModels
+        self.models = models
         self.genes = {}
         self.ribosomals = {}
         self.genesOthers = {}
         self.genesRibosomals = {}
+        self.pfam = PFAM(DefaultValues.PFAM_CLAN_FILE)
 
     def analyseResults(self,
                        outDir,
+                       binIds,
                        hmmTableFile,
                        bIgnoreThresholds,
                        evalueThreshold,
@@ -41,7 +41,7 @@ class ResultsParser():
                        bSkipPseudoGeneCorrection,
                        bSkipAdjCorrection,
                        ):
-        self.parseBinHits(outDir, hmmTableFile, bSkipAdjCorrection, bIgnoreThresholds, evalueThreshold, lengthThreshold, bSkipPseudoGeneCorrection)
+        self.parseBinHits(outDir, binIds, hmmTableFile, bSkipAdjCorrection, bIgnoreThresholds, evalueThreshold, lengthThreshold, bSkipPseudoGeneCorrection)
 
     def cacheResults(self, outDir):
         markerGenesFile = self.__writeMarkerGeneStats(outDir)
@@ -50,18 +50,26 @@ class ResultsParser():
     def __writeMarkerGeneStats(self, directory):
         markerGenesFile = os.path.join(directory, DefaultValues.MARKER_GENE_STATS)
         fout = open(markerGenesFile, 'w')
-        header = "Genome Id\t# ribosomal peaks\t# other peaks\tribosomal list\tothers list\tname\ttaxonomy\n"
-        fout.write(header)
+        fout.write(ResultsParser.peakListHeader())
         for binId in sorted(self.results.keys()):
-            gene_list = ','.join(self.genesOthers[binId])
-            ribo_list = ','.join(self.genesRibosomals[binId])
-            fout.write(str(binId) + "\t" + str(len(self.genesRibosomals[binId])) + "\t" +
-                          str(len(self.genesOthers[binId])) + "\t" + ribo_list + "\t" + gene_list + "\t\t\n")
+            fout.write(ResultsParser.peakListRow(binId, self.genesRibosomals[binId], self.genesOthers[binId]))
         fout.close()
 
         return markerGenesFile
 
+    @staticmethod
+    def peakListHeader():
+        return "Genome Id\t# ribosomal peaks\t# other peaks\tribosomal list\tothers list\tname\ttaxonomy\n"
+
+    @staticmethod
+    def peakListRow(binId, genesRibosomals, genesOthers):
+        gene_list = ','.join(genesOthers)
+        ribo_list = ','.join(genesRibosomals)
+        return (str(binId) + "\t" + str(len(genesRibosomals)) + "\t" +
+                str(len(genesOthers)) + "\t" + ribo_list + "\t" + gene_list + "\t\t\n")
+
     def parseBinHits(self, outDir,
+                     binIds,
                      hmmTableFile,
                      bSkipAdjCorrection=False,
                      bIgnoreThresholds=False,
@@ -75,79 +83,133 @@ class ResultsParser():
         self.logger.info('Parsing HMM hits to marker genes:')
 
         numBinsProcessed = 0
-        for binId in self.models:
-            self.genes[binId] = {}
-            self.ribosomals[binId] = []
-            self.genesOthers[binId] = []
-            self.genesRibosomals[binId] = []
-            geneTableFile = os.path.join(outDir, 'bins', binId, "mw_s.txt")
-            checkFileExists(geneTableFile)
-            for line in open(geneTableFile):
-                if line.rstrip() == "":
-                    break
-                else:
-                    element = line.split("\t")
-                    try:
-                        self.genes[binId][element[0].rstrip()] = element[1].rstrip()
-                    except:
-                        continue
-
+        for binId in binIds:
             if self.logger.getEffectiveLevel() <= logging.INFO:
                 numBinsProcessed += 1
-                statusStr = '    Finished parsing hits for %d of %d (%.2f%%) bins.' % (numBinsProcessed, len(self.models), float(numBinsProcessed) * 100 / len(self.models))
+                statusStr = '    Finished parsing hits for %d of %d (%.2f%%) bins.' % (numBinsProcessed, len(binIds), float(numBinsProcessed) * 100 / len(binIds))
                 sys.stderr.write('%s\r' % statusStr)
                 sys.stderr.flush()
 
-            resultsManager = ResultsManager(binId, self.models[binId], bIgnoreThresholds, evalueThreshold, lengthThreshold, bSkipPseudoGeneCorrection)
-            hmmerTableFile = os.path.join(outDir, 'bins', binId, hmmTableFile)
-            self.parseHmmerResults(hmmerTableFile, resultsManager, bSkipAdjCorrection)
-            self.results[binId] = resultsManager
-            for marker, hitList in resultsManager.markerHits.items():
-                for hit in hitList:
-                    self.ribosomals[binId].append(hit.target_name)
-
-            for n in self.genes[binId].keys():
-                if n in self.ribosomals[binId]:
-                    self.genesRibosomals[binId].append(self.genes[binId][n])
-                else:
-                    self.genesOthers[binId].append(self.genes[binId][n])
+            self.parseGenome(outDir, binId, hmmTableFile, bSkipAdjCorrection, bIgnoreThresholds, evalueThreshold, lengthThreshold, bSkipPseudoGeneCorrection)
 
         if self.logger.getEffectiveLevel() <= logging.INFO:
             sys.stderr.write('\n')
 
-    def parseHmmerResults(self, fileName, resultsManager, bSkipAdjCorrection):
-        try:
-            with open(fileName, 'r') as hmmerHandle:
+    def parseGenome(self, outDir,
+                    binId,
+                    hmmTableFile,
+                    bSkipAdjCorrection=False,
+                    bIgnoreThresholds=False,
+                    evalueThreshold=DefaultValues.E_VAL,
+                    lengthThreshold=DefaultValues.LENGTH,
+                    bSkipPseudoGeneCorrection=False):
+        self.genes[binId] = {}
+        self.ribosomals[binId] = set()
+        self.genesOthers[binId] = []
+        self.genesRibosomals[binId] = []
+        geneTableFile = os.path.join(outDir, 'bins', binId, "mw_s.txt")
+        checkFileExists(geneTableFile)
+        for line in open(geneTableFile):
+            if line.rstrip() == "":
+                break
+            else:
+                element = line.split("\t")
                 try:
-                    HP = HMMERParser(hmmerHandle)
+                    self.genes[binId][element[0].rstrip()] = element[1].rstrip()
                 except:
-                    print("Error opening HMM file: ", fileName)
-                    raise
+                    continue
+
+        resultsManager = ResultsManager(binId, self.models, bIgnoreThresholds, evalueThreshold, lengthThreshold, bSkipPseudoGeneCorrection)
+        hmmerTableFile = os.path.join(outDir, 'bins', binId, hmmTableFile)
+        self.parseHmmerResults(hmmerTableFile, resultsManager, bSkipAdjCorrection)
+        self.results[binId] = resultsManager
+        for marker, hitList in resultsManager.markerHits.items():
+            for hit in hitList:
+                self.ribosomals[binId].add(hit.target_name)
+
+        for n in self.genes[binId].keys():
+            if n in self.ribosomals[binId]:
+                self.genesRibosomals[binId].append(self.genes[binId][n])
+            else:
+                self.genesOthers[binId].append(self.genes[binId][n])
+
+        return GenomeResult(binId, self.genesRibosomals[binId], self.genesOthers[binId])
+
+    def releaseGenome(self, binId):
+        for d in [self.results, self.genes, self.ribosomals, self.genesOthers, self.genesRibosomals]:
+            d.pop(binId, None)
 
-                while True:
-                    hit = HP.next()
-                    if hit is None:
-                        break
+    def parseHmmerResults(self, fileName, resultsManager, bSkipAdjCorrection):
+        try:
+            with open(fileName, 'r') as hmmerHandle:
+                for hit in DomainTableParser(hmmerHandle, fileName):
                     resultsManager.addHit(hit)
 
-                pfam = PFAM(DefaultValues.PFAM_CLAN_FILE)
-                resultsManager.markerHits = pfam.filterHitsFromSameClan(resultsManager.markerHits)
+                resultsManager.markerHits = self.pfam.filterHitsFromSameClan(resultsManager.markerHits)
 
         except IOError as detail:
             sys.stderr.write(str(detail) + "\n")
 
     def printSummary(self, anaFolder):
+        peakCounts = {}
+        for binId in self.results.keys():
+            peakCounts[binId] = (len(self.genesRibosomals[binId]), len(self.genesOthers[binId]))
+
+        self.printPeakCounts(peakCounts)
+
+    def printPeakCounts(self, peakCounts):
         header = "Genome Id\t# ribosomal peaks\t# other peaks"
         self.logger.info(header)
 
-        seqsReported = 0
-        for binId in sorted(self.results.keys()):
-            gene_list = ','.join(self.genesOthers[binId])
-            ribo_list = ','.join(self.genesRibosomals[binId])
-            self.logger.info(str(binId) + "\t" + str(len(self.genesRibosomals[binId])) + "\t" +
-                   str(len(self.genesOthers[binId])))
+        for binId in sorted(peakCounts.keys()):
+            numRibosomals, numOthers = peakCounts[binId]
+            self.logger.info(str(binId) + "\t" + str(numRibosomals) + "\t" + str(numOthers))
+
+
+class DomainHit():
+    __slots__ = ('target_name', 'query_name', 'query_accession', 'query_length',
+                 'full_e_value', 'full_score', 'i_evalue', 'dom_score', 'ali_from', 'ali_to')
+
+    def __init__(self, values):
+        self.target_name = values[0]
+        self.query_name = values[3]
+        self.query_accession = values[4]
+        if self.query_accession == '-':
+            self.query_accession = self.query_name
+        self.query_length = int(values[5])
+        self.full_e_value = float(values[6])
+        self.full_score = float(values[7])
+        self.i_evalue = float(values[12])
+        self.dom_score = float(values[13])
+        self.ali_from = int(values[17])
+        self.ali_to = int(values[18])
+
+
+class DomainTableParser():
+    # reads only the domtblout columns needed to vet hits
+    def __init__(self, fileHandle, fileName=''):
+        self.handle = fileHandle
+        self.fileName = fileName
+
+    def __iter__(self):
+        for line in self.handle:
+            if line[0] == '#' or line.strip() == '':
+                continue
+
+            values = line.split(None, 19)
+            if len(values) < 20:
+                print("Error processing line in HMM file: ", self.fileName)
+                raise ValueError("Error processing line:\n%s" % line)
+
+            yield DomainHit(values)
+
+
+class GenomeResult():
+    def __init__(self, binId, genesRibosomals, genesOthers):
+        self.binId = binId
+        self.genesRibosomals = genesRibosomals
+        self.genesOthers = genesOthers
 
-            
 
 class ResultsManager():
     def __init__(self, binId, models,
@@ -157,13 +219,26 @@ class ResultsManager():
                  bSkipPseudoGeneCorrection=False,
                  binStats=None):
         self.binId = binId
-        self.markerHits = {}
+        self.hitsToORFs = {}
+        self.filteredMarkerHits = None
         self.bIgnoreThresholds = bIgnoreThresholds
         self.evalueThreshold = evalueThreshold
         self.lengthThreshold = lengthThreshold
         self.bSkipPseudoGeneCorrection = bSkipPseudoGeneCorrection
         self.models = models
 
+    @property
+    def markerHits(self):
+        # best hit of each marker to each ORF, in the order the hits were kept
+        if self.filteredMarkerHits is not None:
+            return self.filteredMarkerHits
+
+        return dict((marker, list(hits.values())) for marker, hits in self.hitsToORFs.items())
+
+    @markerHits.setter
+    def markerHits(self, markerHits):
+        self.filteredMarkerHits = markerHits
+
     def vetHit(self, hit):
         model = self.models[hit.query_accession]
 
@@ -198,22 +273,14 @@ class ResultsManager():
 
     def addHit(self, hit):
         if self.vetHit(hit):
-            if hit.query_accession in self.markerHits:
-                previousHitToORF = None
-                for h in self.markerHits[hit.query_accession]:
-                    if h.target_name == hit.target_name:
-                        previousHitToORF = h
-                        break
-
-                if not previousHitToORF:
-                    self.markerHits[hit.query_accession].append(hit)
-                else:
-                    if previousHitToORF.dom_score < hit.dom_score:
-                        self.markerHits[hit.query_accession].append(hit)
-                        self.markerHits[hit.query_accession].remove(previousHitToORF)
-
-            else:
-                self.markerHits[hit.query_accession] = [hit]
+            hits = self.hitsToORFs.setdefault(hit.query_accession, {})
+            previousHitToORF = hits.get(hit.target_name)
+            if previousHitToORF is None:
+                hits[hit.target_name] = hit
+            elif previousHitToORF.dom_score < hit.dom_score:
+                # a better hit replaces the previous one and moves to the end
+                del hits[hit.target_name]
+                hits[hit.target_name] = hit
 
     def countUniqueHits(self):
         uniqueHits = 0
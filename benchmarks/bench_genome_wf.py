@@ -0,0 +1,254 @@
+#!/usr/bin/env python
+
+__author__ = 'Yuji Sekiguchi'
+__copyright__ = 'Copyright (c) 2023 Yuji Sekiguchi, National Institute of Advanced Industrial Science and Technology (AIST)'
+__credits__ = ['Yuji Sekiguchi']
+__license__ = 'GPL3.0'
+__maintainer__ = 'Yuji Sekiguchi'
+__email__ = 'y.sekiguchi@aist.go.jp'
+__status__ = 'Development'
+
+# End-to-end benchmark of genome_wf on synthetic genomes. The stand-in
+# prodigal and hmmsearch in benchmarks/stubs are put first on PATH, so the
+# numbers measure the orchestration in GPMsDB_dbtk (work scheduling, Mw,
+# result parsing and the custom db) rather than the external tools, and can
+# be compared between commits on any Linux machine.
+#
+# For every genome count and thread count the workflow is run once and the
+# following are reported:
+#   genomes/s         genomes processed per second of wall time
+#   parent_rss_kb     peak resident memory of the genome_wf parent process
+#   child_rss_kb      peak resident memory of the largest child process
+#   total_rss_kb      largest sum of resident memory over the whole process
+#                     tree seen while the workflow ran
+#   peak_files/bytes  largest number of files and bytes under out_dir seen
+#                     while the workflow ran (temporary file churn)
+#   final_files/bytes files and bytes left in out_dir at the end
+#   update_db_s       time to add the resulting peak list to an empty db
+#   list_db_s         time to list the db afterwards
+#
+# Usage:
+#   python benchmarks/bench_genome_wf.py --genomes 10 1000 10000 --threads 1 4 8
+
+import os
+import sys
+import json
+import time
+import shutil
+import argparse
+import threading
+import subprocess
+
+import synthetic
+
+BENCH_DIR = os.path.dirname(os.path.abspath(__file__))
+REPO_DIR = os.path.dirname(BENCH_DIR)
+STUB_DIR = os.path.join(BENCH_DIR, 'stubs')
+GPMSDB_DBTK = os.path.join(REPO_DIR, 'bin', 'GPMsDB_dbtk')
+
+COLUMNS = ['genomes', 'threads', 'wall_s', 'genomes_per_s', 'parent_rss_kb', 'child_rss_kb', 'total_rss_kb',
+           'peak_files', 'peak_bytes', 'final_files', 'final_bytes', 'update_db_s', 'list_db_s']
+
+
+def environment(refDir, stubDelay):
+    env = dict(os.environ)
+    env['PATH'] = STUB_DIR + os.pathsep + env.get('PATH', '')
+    env['PYTHONPATH'] = REPO_DIR + os.pathsep + env.get('PYTHONPATH', '')
+    env['GPMsDB_PATH'] = refDir
+    env['BENCH_STUB_DELAY'] = str(stubDelay)
+
+    return env
+
+
+def procRss(pid):
+    # current and peak resident memory of a running process, in kB
+    rss = 0
+    hwm = 0
+    try:
+        with open('/proc/%d/status' % pid) as f:
+            for line in f:
+                if line.startswith('VmRSS:'):
+                    rss = int(line.split()[1])
+                elif line.startswith('VmHWM:'):
+                    hwm = int(line.split()[1])
+    except OSError:
+        pass
+
+    return rss, hwm
+
+
+def descendants(pid):
+    pids = []
+    stack = [pid]
+    while stack:
+        p = stack.pop()
+        try:
+            for task in os.listdir('/proc/%d/task' % p):
+                with open('/proc/%d/task/%s/children' % (p, task)) as f:
+                    children = [int(c) for c in f.read().split()]
+                pids.extend(children)
+                stack.extend(children)
+        except OSError:
+            pass
+
+    return pids
+
+
+def dirUsage(path):
+    numFiles = 0
+    numBytes = 0
+    for root, _, files in os.walk(path):
+        for f in files:
+            try:
+                numBytes += os.lstat(os.path.join(root, f)).st_size
+                numFiles += 1
+            except OSError:
+                pass
+
+    return numFiles, numBytes
+
+
+def runGenomeWf(genomeDir, outDir, threads, env, pollInterval):
+    if os.path.exists(outDir):
+        shutil.rmtree(outDir)
+
+    cmd = [sys.executable, GPMSDB_DBTK, 'genome_wf', genomeDir, outDir, '-t', str(threads), '--silent']
+
+    peakRss = 0
+    peakChildRss = 0
+    peakTotalRss = 0
+    peakFiles = 0
+    peakBytes = 0
+
+    start = time.time()
+    proc = subprocess.Popen(cmd, env=env, stdout=subprocess.DEVNULL, stderr=subprocess.PIPE)
+
+    # stderr is drained by a thread so the progress messages can not fill the pipe
+    stderr = []
+    reader = threading.Thread(target=lambda: stderr.append(proc.stderr.read()))
+    reader.start()
+
+    while proc.poll() is None:
+        rss, hwm = procRss(proc.pid)
+        peakRss = max(peakRss, hwm)
+        totalRss = rss
+        for pid in descendants(proc.pid):
+            childRss, childHwm = procRss(pid)
+            peakChildRss = max(peakChildRss, childHwm)
+            totalRss += childRss
+        peakTotalRss = max(peakTotalRss, totalRss)
+
+        numFiles, numBytes = dirUsage(outDir)
+        peakFiles = max(peakFiles, numFiles)
+        peakBytes = max(peakBytes, numBytes)
+        time.sleep(pollInterval)
+
+    wall = time.time() - start
+    reader.join()
+
+    if proc.returncode != 0:
+        sys.stderr.write(stderr[0].decode(errors='replace'))
+        raise RuntimeError('genome_wf exited with code %d' % proc.returncode)
+
+    finalFiles, finalBytes = dirUsage(outDir)
+
+    return {'wall_s': wall,
+            'parent_rss_kb': peakRss,
+            'child_rss_kb': peakChildRss,
+            'total_rss_kb': peakTotalRss,
+            'peak_files': max(peakFiles, finalFiles),
+            'peak_bytes': max(peakBytes, finalBytes),
+            'final_files': finalFiles,
+            'final_bytes': finalBytes}
+
+
+def runDbCommands(refDir, outDir, env):
+    synthetic.resetCustomDb(refDir)
+
+    peakFile = os.path.join(outDir, 'peak_list_genomes.tsv')
+    start = time.time()
+    subprocess.run([sys.executable, GPMSDB_DBTK, 'update_db', peakFile, '--silent'], env=env, check=True,
+                   stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    updateTime = time.time() - start
+
+    start = time.time()
+    subprocess.run([sys.executable, GPMSDB_DBTK, 'list_db', '--silent'], env=env, check=True,
+                   stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    listTime = time.time() - start
+
+    return updateTime, listTime
+
+
+def stageTotals(outDir):
+    try:
+        with open(os.path.join(outDir, 'metrics_summary.json')) as f:
+            summary = json.load(f)
+    except (OSError, ValueError):
+        return {}
+
+    return dict((stage, values['wall_s']) for stage, values in summary.get('stages', {}).items())
+
+
+def formatValue(value):
+    if value is None:
+        return '-'
+    if isinstance(value, float):
+        return '%.3f' % value
+
+    return str(value)
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark genome_wf on synthetic genomes with stand-in prodigal and hmmsearch.')
+    parser.add_argument('--genomes', type=int, nargs='+', default=[10, 1000, 10000], help='numbers of genomes to run')
+    parser.add_argument('--threads', type=int, nargs='+', default=[1, 4, 8], help='values of --threads to run')
+    parser.add_argument('--work_dir', default=os.path.join(BENCH_DIR, 'work'), help='directory for genomes, reference data and outputs; genomes are reused between runs')
+    parser.add_argument('--stub_delay', type=float, default=0.0, help='seconds each stand-in call sleeps to mimic the real tools')
+    parser.add_argument('--poll', type=float, default=0.2, help='seconds between memory and file count samples')
+    parser.add_argument('--no_db', action='store_true', default=False, help='skip timing update_db and list_db')
+    parser.add_argument('--keep', action='store_true', default=False, help='keep genome_wf outputs')
+    parser.add_argument('-o', '--out_file', help='also write the results as JSON lines to this file')
+    args = parser.parse_args()
+
+    workDir = os.path.abspath(args.work_dir)
+    genomeDir = os.path.join(workDir, 'genomes')
+    refDir = synthetic.makeReferenceData(os.path.join(workDir, 'ref'))
+    env = environment(refDir, args.stub_delay)
+
+    sys.stderr.write('Generating %d synthetic genomes in %s\n' % (max(args.genomes), genomeDir))
+    genomeFiles = synthetic.makeGenomes(genomeDir, max(args.genomes))
+
+    fout = open(args.out_file, 'a') if args.out_file else None
+    print('\t'.join(COLUMNS + ['stage_wall_s']))
+    for numGenomes in args.genomes:
+        subsetDir = synthetic.genomeSubset(genomeDir, genomeFiles[:numGenomes], os.path.join(workDir, 'sets', str(numGenomes)))
+
+        for threads in args.threads:
+            outDir = os.path.join(workDir, 'out', '%d_t%d' % (numGenomes, threads))
+            result = {'genomes': numGenomes, 'threads': threads}
+            result.update(runGenomeWf(subsetDir, outDir, threads, env, args.poll))
+            result['genomes_per_s'] = numGenomes / result['wall_s']
+
+            result['update_db_s'] = None
+            result['list_db_s'] = None
+            if not args.no_db:
+                result['update_db_s'], result['list_db_s'] = runDbCommands(refDir, outDir, env)
+
+            result['stage_wall_s'] = stageTotals(outDir)
+
+            stages = ','.join('%s=%.2f' % (stage, wall) for stage, wall in result['stage_wall_s'].items())
+            print('\t'.join([formatValue(result[c]) for c in COLUMNS] + [stages]))
+            sys.stdout.flush()
+            if fout:
+                fout.write(json.dumps(result) + '\n')
+                fout.flush()
+
+            if not args.keep:
+                shutil.rmtree(outDir)
+
+    if fout:
+        fout.close()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,264 @@
+#!/usr/bin/env python
+
+__author__ = 'Yuji Sekiguchi'
+__copyright__ = 'Copyright (c) 2023 Yuji Sekiguchi, National Institute of Advanced Industrial Science and Technology (AIST)'
+__credits__ = ['Yuji Sekiguchi']
+__license__ = 'GPL3.0'
+__maintainer__ = 'Yuji Sekiguchi'
+__email__ = 'y.sekiguchi@aist.go.jp'
+__status__ = 'Development'
+
+# Microbenchmarks of the inner loops of GPMsDB_dbtk on synthetic inputs.
+# Every benchmark has an untimed setup, an optional untimed reset before
+# each repeat, and a timed call. The min, median and max of the repeats are
+# reported, and can be saved as a baseline and compared against later:
+#
+#   python benchmarks/bench_micro.py --save my_baseline.json
+#   python benchmarks/bench_micro.py --compare my_baseline.json
+#
+# Comparisons are only meaningful on the machine the baseline was recorded
+# on; the machine details and the commit are saved with the numbers. Use -b
+# to run only some of the benchmarks.
+#
+# benchmarks/reference_micro.json is a reference recorded on the tree named
+# in its "commit" field, after the optimisations these benchmarks were
+# written for. It is not a measurement of the code before them: most
+# benchmarks call functions that did not exist yet and can not run there.
+
+import os
+import sys
+import json
+import time
+import shutil
+import logging
+import argparse
+import platform
+import subprocess
+import statistics
+
+import synthetic
+
+BENCH_DIR = os.path.dirname(os.path.abspath(__file__))
+REPO_DIR = os.path.dirname(BENCH_DIR)
+
+# (name, setup function, default number of repeats), in the order they run
+BENCHMARKS = []
+
+
+def benchmark(name, repeat=5):
+    def register(setup):
+        BENCHMARKS.append((name, setup, repeat))
+        return setup
+
+    return register
+
+
+@benchmark('mw_run', repeat=10)
+def mwRun(workDir, args):
+    # masses of a whole proteome, writing mw.txt, mw_s.txt and the
+    # mass window proteins as genome_wf does
+    from GPMsDB_dbtk.mw import Mw
+
+    binDir = os.path.join(workDir, 'mw')
+    os.makedirs(binDir, exist_ok=True)
+    aaFile = synthetic.writeProteome(os.path.join(binDir, 'genes.faa'), args.proteins)
+    windowAaFile = os.path.join(binDir, 'genes_mw.faa')
+
+    return lambda: Mw().run(aaFile, windowAaFile), None
+
+
+@benchmark('mw_calc_long_protein', repeat=10)
+def mwCalcLongProtein(workDir, args):
+    # masses of a proteome with one very long protein, which must not add
+    # one vectorised step per residue beyond the length of the others
+    import random
+    from GPMsDB_dbtk.mw import Mw
+
+    rng = random.Random(0)
+    seqs = [synthetic.randomProtein(rng, rng.randint(30, 900)) for _ in range(args.proteins)]
+    seqs.append(synthetic.randomProtein(rng, args.long_protein))
+
+    return lambda: Mw().calcMasses(seqs), None
+
+
+@benchmark('gff_parser', repeat=5)
+def gffParser(workDir, args):
+    # parsing a large GFF and the coding bases of every contig, as Prodigal
+    # does to compare translation tables
+    from GPMsDB_dbtk.util.prodigal import ProdigalGeneFeatureParser
+
+    gffFile = synthetic.writeGff(os.path.join(workDir, 'genes.gff'), args.gff_contigs, args.gff_genes // args.gff_contigs)
+
+    def run():
+        parser = ProdigalGeneFeatureParser(gffFile)
+        return sum(parser.codingBases(seqId) for seqId in parser.genes)
+
+    return run, None
+
+
+@benchmark('pfam_filter_same_clan', repeat=5)
+def pfamFilter(workDir, args):
+    # clan filtering of many overlapping hits to each ORF
+    from GPMsDB_dbtk.util.pfam import PFAM
+    from GPMsDB_dbtk.util.resultsParser import DomainTableParser
+
+    clanFile = synthetic.writeClanFile(os.path.join(workDir, 'Pfam-A.hmm.dat'))
+    hits = DomainTableParser(synthetic.domainTableRows(args.pfam_orfs, args.pfam_hits_per_orf))
+
+    markerHits = {}
+    for hit in hits:
+        markerHits.setdefault(hit.query_accession, []).append(hit)
+
+    pfam = PFAM(clanFile)
+    pfam.filterHitsFromSameClan({})
+
+    return lambda: pfam.filterHitsFromSameClan(markerHits), None
+
+
+@benchmark('results_manager_add_hit', repeat=5)
+def addHit(workDir, args):
+    # vetting and keeping the best hit of every marker to every ORF
+    from biolib.external.hmmer import HmmModelParser
+    from GPMsDB_dbtk.util.resultsParser import DomainTableParser, ResultsManager
+
+    models = HmmModelParser(os.path.join(args.ref_dir, 'hmm', 'ribosomal.hmm')).models()
+    hits = list(DomainTableParser(synthetic.domainTableRows(args.add_hit_orfs, args.add_hit_hits_per_orf, seed=1)))
+
+    def run():
+        resultsManager = ResultsManager('bin', models)
+        for hit in hits:
+            resultsManager.addHit(hit)
+        return resultsManager
+
+    return run, None
+
+
+def customDbBenchmark(workDir, args, backend, command):
+    # the db is restored from a saved copy before every repeat, with its peak
+    # store already built as it is after any earlier command
+    from GPMsDB_dbtk.db import SqliteDb, openDb
+
+    customDir = os.path.join(args.ref_dir, 'custom')
+    savedDir = os.path.join(workDir, 'custom_%s_%d' % (backend, args.db_genomes))
+    if not os.path.exists(savedDir):
+        synthetic.makeCustomDb(args.ref_dir, args.db_genomes)
+        if backend == 'sqlite':
+            SqliteDb.migrate()
+        db = openDb()
+        with db.writeLock():
+            db.loadDb()
+            db.savePeakStore()
+        shutil.copytree(customDir, savedDir)
+
+    def reset():
+        shutil.rmtree(customDir)
+        shutil.copytree(savedDir, customDir)
+
+    if command == 'add':
+        peakFile = synthetic.writePeakList(os.path.join(workDir, 'new_peaks.tsv'), args.db_batch)
+        return lambda: openDb().add([peakFile]), reset
+    elif command == 'remove':
+        accessions = ','.join('GCC_G%07d' % i for i in range(0, args.db_genomes, max(1, args.db_genomes // args.db_batch)))
+        return lambda: openDb().remove(accessions), reset
+    else:
+        outFile = os.path.join(workDir, 'list_db.tsv')
+        return lambda: openDb().list(outFile=outFile), reset
+
+
+for backend in ['pickle', 'sqlite']:
+    for command in ['add', 'remove', 'list']:
+        benchmark('db_%s_%s' % (command, backend), repeat=3)(
+            lambda workDir, args, backend=backend, command=command: customDbBenchmark(workDir, args, backend, command))
+
+
+def timeBenchmark(run, reset, repeat):
+    times = []
+    for _ in range(repeat):
+        if reset:
+            reset()
+        start = time.perf_counter()
+        run()
+        times.append(time.perf_counter() - start)
+
+    return {'repeat': repeat, 'min_s': min(times), 'median_s': statistics.median(times), 'max_s': max(times)}
+
+
+def machine():
+    import numpy
+
+    return {'python': platform.python_version(), 'numpy': numpy.__version__,
+            'platform': platform.platform(), 'processor': platform.processor(),
+            'cpus': os.cpu_count()}
+
+
+def commit():
+    # the commit of the benchmarked tree, or None outside a git checkout
+    try:
+        return subprocess.check_output(['git', 'rev-parse', '--short', 'HEAD'], cwd=REPO_DIR,
+                                       stderr=subprocess.DEVNULL, universal_newlines=True).strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Microbenchmarks of the inner loops of GPMsDB_dbtk.')
+    parser.add_argument('-b', '--benchmarks', nargs='+', help='run only benchmarks whose name contains one of these strings')
+    parser.add_argument('-r', '--repeat', type=int, help='repeats of every benchmark (default: per benchmark)')
+    parser.add_argument('--work_dir', default=os.path.join(BENCH_DIR, 'work', 'micro'), help='directory for the synthetic inputs')
+    parser.add_argument('--save', help='write the results as a baseline JSON file')
+    parser.add_argument('--compare', help='compare the medians against a baseline JSON file')
+    parser.add_argument('--proteins', type=int, default=10000, help='proteins in the Mw proteome')
+    parser.add_argument('--long_protein', type=int, default=35000, help='residues of the long protein added to the Mw proteome')
+    parser.add_argument('--gff_genes', type=int, default=100000, help='genes in the GFF file')
+    parser.add_argument('--gff_contigs', type=int, default=500, help='contigs in the GFF file')
+    parser.add_argument('--pfam_orfs', type=int, default=5000, help='ORFs hit in the clan filter benchmark')
+    parser.add_argument('--pfam_hits_per_orf', type=int, default=20, help='overlapping hits to each ORF in the clan filter benchmark')
+    parser.add_argument('--add_hit_orfs', type=int, default=50000, help='ORFs hit in the addHit benchmark')
+    parser.add_argument('--add_hit_hits_per_orf', type=int, default=4, help='hits to each ORF in the addHit benchmark')
+    parser.add_argument('--db_genomes', type=int, default=100000, help='genomes in the synthetic custom db')
+    parser.add_argument('--db_batch', type=int, default=1000, help='genomes added or removed by the db benchmarks')
+    args = parser.parse_args()
+
+    workDir = os.path.abspath(args.work_dir)
+    os.makedirs(workDir, exist_ok=True)
+
+    # the reference data path is read when GPMsDB_dbtk is first imported
+    args.ref_dir = synthetic.makeReferenceData(os.path.join(workDir, 'ref'))
+    os.environ['GPMsDB_PATH'] = args.ref_dir
+    sys.path.insert(0, REPO_DIR)
+    logging.getLogger('GPMsDB_tk').setLevel(logging.ERROR)
+
+    baseline = {}
+    if args.compare:
+        with open(args.compare) as f:
+            saved = json.load(f)
+        baseline = saved['results']
+        for k, v in saved['sizes'].items():
+            if getattr(args, k, v) != v:
+                sys.stderr.write('Warning: --%s is %s here but %s in the baseline\n' % (k, getattr(args, k), v))
+
+    results = {}
+    print('%-30s %6s %10s %10s %10s %10s' % ('benchmark', 'repeat', 'min_s', 'median_s', 'max_s', 'vs_base'))
+    for name, setup, repeat in BENCHMARKS:
+        if args.benchmarks and not any(b in name for b in args.benchmarks):
+            continue
+
+        run, reset = setup(workDir, args)
+        result = timeBenchmark(run, reset, args.repeat or repeat)
+        results[name] = result
+
+        ratio = '-'
+        if name in baseline:
+            ratio = '%.2fx' % (result['median_s'] / baseline[name]['median_s'])
+        print('%-30s %6d %10.4f %10.4f %10.4f %10s' % (name, result['repeat'], result['min_s'], result['median_s'], result['max_s'], ratio))
+        sys.stdout.flush()
+
+    if args.save:
+        sizes = dict((k, v) for k, v in vars(args).items() if k not in ('benchmarks', 'repeat', 'work_dir', 'save', 'compare', 'ref_dir'))
+        with open(args.save, 'w') as fout:
+            json.dump({'commit': commit(), 'machine': machine(), 'sizes': sizes, 'results': results}, fout, indent=2)
+            fout.write('\n')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,256 @@
+#!/usr/bin/env python
+
+__author__ = 'Yuji Sekiguchi'
+__copyright__ = 'Copyright (c) 2023 Yuji Sekiguchi, National Institute of Advanced Industrial Science and Technology (AIST)'
+__credits__ = ['Yuji Sekiguchi']
+__license__ = 'GPL3.0'
+__maintainer__ = 'Yuji Sekiguchi'
+__email__ = 'y.sekiguchi@aist.go.jp'
+__status__ = 'Development'
+
+# Synthetic inputs for the benchmarks: genomes with a mix of sizes, GC
+# contents and contig counts, a reference data package with a marker HMM
+# file and a custom db, and the proteomes, GFF files, clan records, domain
+# table rows and peak lists read by the inner loops. Everything is generated
+# from fixed seeds so repeated runs see the same data.
+
+import os
+import shutil
+import pickle
+import random
+
+MARKER_NAMES = ['Ribosomal_L%d' % i for i in range(1, 31)] + ['Ribosomal_S%d' % i for i in range(1, 22)]
+
+CUSTOM_DBS = ['custom_ribosomals.db', 'custom_others.db', 'custom_genes.db', 'custom_names.db', 'custom_taxonomy.db']
+
+# (fraction of genomes, min and max genome size in bp)
+SIZE_CLASSES = [(0.6, 10000, 30000), (0.3, 30000, 100000), (0.1, 100000, 300000)]
+
+
+def randomSequence(rng, length, gc):
+    # random bytes mapped to bases so large genomes are generated quickly
+    numGC = int(round(256 * gc / 2))
+    numAT = 128 - numGC
+    table = bytes(b'A' * numAT + b'C' * numGC + b'G' * numGC + b'T' * numAT)
+    return rng.randbytes(length).translate(table).decode()
+
+
+def genomeSize(rng):
+    r = rng.random()
+    for fraction, minSize, maxSize in SIZE_CLASSES:
+        if r < fraction:
+            return rng.randint(minSize, maxSize)
+        r -= fraction
+
+    return SIZE_CLASSES[-1][2]
+
+
+def writeGenome(genomeFile, seed):
+    rng = random.Random(seed)
+    size = genomeSize(rng)
+    gc = rng.uniform(0.3, 0.7)
+    numContigs = rng.randint(1, 20)
+
+    # contig lengths from random breakpoints
+    breaks = sorted(rng.sample(range(1, size), numContigs - 1)) if numContigs > 1 else []
+    lengths = [b - a for a, b in zip([0] + breaks, breaks + [size])]
+
+    tmpFile = genomeFile + '.tmp'
+    with open(tmpFile, 'w') as fout:
+        for i, length in enumerate(lengths, 1):
+            seq = randomSequence(rng, length, gc)
+            fout.write('>contig_%d length=%d\n' % (i, length))
+            for j in range(0, length, 80):
+                fout.write(seq[j:j + 80] + '\n')
+    os.replace(tmpFile, genomeFile)
+
+    return size
+
+
+def makeGenomes(genomeDir, numGenomes, ext='fna'):
+    # genomes are kept between runs so larger sets reuse smaller ones
+    os.makedirs(genomeDir, exist_ok=True)
+
+    genomeFiles = []
+    for i in range(numGenomes):
+        genomeFile = os.path.join(genomeDir, 'G%06d.%s' % (i, ext))
+        if not os.path.exists(genomeFile):
+            writeGenome(genomeFile, i)
+        genomeFiles.append(genomeFile)
+
+    return genomeFiles
+
+
+def genomeSubset(genomeDir, genomeFiles, subsetDir):
+    # a directory with links to the first genomes, for runs on part of a set
+    os.makedirs(subsetDir, exist_ok=True)
+    for genomeFile in genomeFiles:
+        link = os.path.join(subsetDir, os.path.basename(genomeFile))
+        if not os.path.lexists(link):
+            os.symlink(os.path.abspath(genomeFile), link)
+
+    return subsetDir
+
+
+def makeReferenceData(refDir, numMarkers=len(MARKER_NAMES)):
+    # the parts of a reference data package read by genome_wf and the custom
+    # db commands; model bodies are never read since hmmsearch is a stand-in
+    hmmDir = os.path.join(refDir, 'hmm')
+    customDir = os.path.join(refDir, 'custom')
+    os.makedirs(hmmDir, exist_ok=True)
+    os.makedirs(customDir, exist_ok=True)
+
+    hmmFile = os.path.join(hmmDir, 'ribosomal.hmm')
+    if not os.path.exists(hmmFile):
+        with open(hmmFile, 'w') as fout:
+            for i, name in enumerate(MARKER_NAMES[:numMarkers]):
+                fout.write('HMMER3/f [3.1b2 | February 2015]\n')
+                fout.write('NAME  %s\n' % name)
+                fout.write('ACC   %s\n' % markerAccession(i))
+                fout.write('LENG  %d\n' % (60 + (i * 7) % 120))
+                fout.write('GA    %.2f %.2f;\n' % (20 + i % 5, 15 + i % 5))
+                fout.write('TC    %.2f %.2f;\n' % (22 + i % 5, 17 + i % 5))
+                fout.write('HMM          A        C        D        E\n')
+                fout.write('//\n')
+
+    resetCustomDb(refDir)
+
+    return refDir
+
+
+def resetCustomDb(refDir):
+    customDir = os.path.join(refDir, 'custom')
+    for f in os.listdir(customDir):
+        path = os.path.join(customDir, f)
+        if os.path.isdir(path):
+            shutil.rmtree(path)
+        else:
+            os.remove(path)
+
+    for db in CUSTOM_DBS:
+        with open(os.path.join(customDir, db), 'wb') as fout:
+            pickle.dump({}, fout)
+
+
+def randomProtein(rng, length):
+    return 'M' + ''.join(rng.choices('ACDEFGHIKLMNPQRSTVWY', k=length - 1))
+
+
+def writeProteome(aaFile, numProteins, seed=0):
+    # proteins of 30-900 residues with Prodigal style headers
+    rng = random.Random(seed)
+    with open(aaFile, 'w') as fout:
+        for i in range(1, numProteins + 1):
+            length = rng.randint(30, 900)
+            fout.write('>contig_%d_%d # 1 # %d # 1 # ID=%d_%d;partial=00\n' % (i // 100 + 1, i, 3 * length, i // 100 + 1, i))
+            protein = randomProtein(rng, length) + '*'
+            for j in range(0, len(protein), 60):
+                fout.write(protein[j:j + 60] + '\n')
+
+    return aaFile
+
+
+def writeGff(gffFile, numContigs, genesPerContig, seed=0):
+    # Prodigal GFF with genes on both strands and some overlapping genes
+    rng = random.Random(seed)
+    with open(gffFile, 'w') as fout:
+        fout.write('##gff-version  3\n')
+        for c in range(1, numContigs + 1):
+            seqId = 'contig_%d' % c
+            genes = []
+            pos = rng.randint(1, 200)
+            for _ in range(genesPerContig):
+                length = 3 * rng.randint(40, 600)
+                genes.append((pos, pos + length - 1))
+                pos += length + rng.randint(-20, 150)
+                pos = max(pos, genes[-1][0] + 3)
+
+            fout.write('# Sequence Data: seqnum=%d;seqlen=%d;seqhdr="%s"\n' % (c, pos + 100, seqId))
+            fout.write('# Model Data: version=Prodigal.v2.6.3;run_type=Single;model="Ab initio";gc_cont=50.00;transl_table=11;uses_sd=1\n')
+            for g, (start, end) in enumerate(genes, 1):
+                fout.write('%s\tProdigal_v2.6.3\tCDS\t%d\t%d\t%.1f\t%s\t0\tID=%d_%d;partial=00;start_type=ATG;rbs_motif=AGGAGG;rbs_spacer=5-10bp;gc_cont=0.500;conf=99.99;score=%.2f;\n' % (
+                    seqId, start, end, 50.0, '+' if rng.random() < 0.5 else '-', c, g, 50.0))
+
+    return gffFile
+
+
+def markerAccession(i):
+    return 'PF%05d.%d' % (100 + i, 10 + i % 10)
+
+
+def writeClanFile(clanFile, numMarkers=len(MARKER_NAMES), clanSize=5):
+    # Pfam-A.hmm.dat style clan and nesting records for the marker models;
+    # every clanSize consecutive models share a clan and every tenth model is
+    # nested with the next one
+    with open(clanFile, 'w') as fout:
+        for i, name in enumerate(MARKER_NAMES[:numMarkers]):
+            fout.write('# STOCKHOLM 1.0\n')
+            fout.write('#=GF ID   %s\n' % name)
+            fout.write('#=GF AC   %s\n' % markerAccession(i))
+            fout.write('#=GF CL   CL%04d\n' % (i // clanSize + 1))
+            if i % 10 == 0 and i + 1 < numMarkers:
+                fout.write('#=GF NE   %s\n' % MARKER_NAMES[i + 1])
+            fout.write('//\n')
+
+    return clanFile
+
+
+def domainTableRows(numOrfs, hitsPerOrf, numMarkers=len(MARKER_NAMES), seed=0):
+    # domtblout rows with many overlapping hits to each ORF from models of
+    # the same and of different clans
+    rng = random.Random(seed)
+    rows = []
+    for orf in range(numOrfs):
+        tlen = rng.randint(80, 400)
+        for _ in range(hitsPerOrf):
+            i = rng.randrange(numMarkers)
+            qlen = 60 + (i * 7) % 120
+            aliFrom = rng.randint(1, max(1, tlen - 40))
+            aliTo = min(tlen, aliFrom + rng.randint(20, qlen))
+            score = rng.uniform(5, 200)
+            evalue = 10 ** -(score / 8.0)
+            rows.append('orf_%d - %d %s %s %d %.2g %.1f 0.1 1 1 %.2g %.2g %.1f 0.1 1 %d %d %d %d %d 0.95 -\n' % (
+                orf, tlen, MARKER_NAMES[i], markerAccession(i), qlen, evalue, score,
+                evalue, evalue, score * rng.uniform(0.5, 1.0), qlen, aliFrom, aliTo, aliFrom, aliTo))
+
+    return rows
+
+
+def peakList(rng, numPeaks):
+    return ','.join('%.5f' % rng.uniform(2000, 15000) for _ in range(numPeaks))
+
+
+def writePeakList(peakFile, numGenomes, numRibosomals=10, numOthers=30, prefix='N', seed=0):
+    # a peak_list_genomes.tsv as written by genome_wf
+    rng = random.Random(seed)
+    with open(peakFile, 'w') as fout:
+        fout.write('Genome Id\t# ribosomal peaks\t# other peaks\tribosomal list\tothers list\tname\ttaxonomy\n')
+        for i in range(numGenomes):
+            fout.write('%s%07d\t%d\t%d\t%s\t%s\tGenome %d\td__Bacteria;p__Phylum%d\n' % (
+                prefix, i, numRibosomals, numOthers, peakList(rng, numRibosomals), peakList(rng, numOthers), i, i % 50))
+
+    return peakFile
+
+
+def makeCustomDb(refDir, numGenomes, numRibosomals=10, numOthers=30, seed=0):
+    # a custom db of numGenomes entries written directly as the pickled dicts
+    # update_db would produce
+    rng = random.Random(seed)
+    ribosomals = {}
+    others = {}
+    genes = {}
+    names = {}
+    tax = {}
+    for i in range(numGenomes):
+        genomeId = 'GCC_G%07d' % i
+        ribosomals[genomeId] = peakList(rng, numRibosomals).split(',')
+        others[genomeId] = peakList(rng, numOthers).split(',')
+        genes[genomeId] = numRibosomals + numOthers
+        names[genomeId] = 'Genome %d' % i
+        tax[genomeId] = 'd__Bacteria;p__Phylum%d' % (i % 50)
+
+    resetCustomDb(refDir)
+    customDir = os.path.join(refDir, 'custom')
+    for db, d in zip(CUSTOM_DBS, [ribosomals, others, genes, names, tax]):
+        with open(os.path.join(customDir, db), 'wb') as fout:
+            pickle.dump(d, fout)
@@ -0,0 +1,49 @@
+#!/usr/bin/env python
+
+__author__ = 'Yuji Sekiguchi'
+__copyright__ = 'Copyright (c) 2023 Yuji Sekiguchi, National Institute of Advanced Industrial Science and Technology (AIST)'
+__credits__ = ['Yuji Sekiguchi']
+__license__ = 'GPL3.0'
+__maintainer__ = 'Yuji Sekiguchi'
+__email__ = 'y.sekiguchi@aist.go.jp'
+__status__ = 'Development'
+
+# The reference data path is read when GPMsDB_dbtk is first imported, so the
+# tests share one temporary reference directory whose custom db is reset by
+# each test that uses it.
+#
+#   python -m unittest discover tests
+
+import os
+import shutil
+import pickle
+import tempfile
+
+REF_DIR = tempfile.mkdtemp(prefix='GPMsDB_dbtk_tests_')
+os.environ['GPMsDB_PATH'] = REF_DIR
+
+CUSTOM_DIR = os.path.join(REF_DIR, 'custom')
+CUSTOM_DBS = ['custom_ribosomals.db', 'custom_others.db', 'custom_genes.db', 'custom_names.db', 'custom_taxonomy.db']
+
+
+def resetCustomDb():
+    # an empty pickled custom db, as shipped with the reference data
+    if os.path.exists(CUSTOM_DIR):
+        shutil.rmtree(CUSTOM_DIR)
+    os.makedirs(CUSTOM_DIR)
+
+    for db in CUSTOM_DBS:
+        with open(os.path.join(CUSTOM_DIR, db), 'wb') as fout:
+            pickle.dump({}, fout)
+
+
+def writePeakList(peakFile, genomeIds, firstMass=3000.0):
+    # a peak_list_genomes.tsv as written by genome_wf, with two ribosomal and
+    # one other peak per genome
+    with open(peakFile, 'w') as fout:
+        fout.write('Genome Id\t# ribosomal peaks\t# other peaks\tribosomal list\tothers list\tname\ttaxonomy\n')
+        for i, genomeId in enumerate(genomeIds):
+            mass = firstMass + 10 * i
+            fout.write('%s\t2\t1\t%.2f,%.2f\t%.2f\tGenome %s\td__Bacteria;p__Test\n' % (genomeId, mass, mass + 1000, mass + 2000, genomeId))
+
+    return peakFile
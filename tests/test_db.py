@@ -0,0 +1,94 @@
+#!/usr/bin/env python
+
+__author__ = 'Yuji Sekiguchi'
+__copyright__ = 'Copyright (c) 2023 Yuji Sekiguchi, National Institute of Advanced Industrial Science and Technology (AIST)'
+__credits__ = ['Yuji Sekiguchi']
+__license__ = 'GPL3.0'
+__maintainer__ = 'Yuji Sekiguchi'
+__email__ = 'y.sekiguchi@aist.go.jp'
+__status__ = 'Development'
+
+import os
+import logging
+import unittest
+import multiprocessing as mp
+
+from tests import CUSTOM_DIR, resetCustomDb, writePeakList
+
+from GPMsDB_dbtk.db import Db, SqliteDb
+from GPMsDB_dbtk.defaultValues import DefaultValues
+from GPMsDB_dbtk.peakStore import PeakStore
+
+
+def addGenomes(peakFiles):
+    for peakFile in peakFiles:
+        SqliteDb().add([peakFile])
+
+
+class TestSqliteDb(unittest.TestCase):
+    def setUp(self):
+        logging.getLogger('GPMsDB_tk').setLevel(logging.ERROR)
+        resetCustomDb()
+        SqliteDb.migrate()
+
+    def tableIds(self):
+        conn = SqliteDb().connect(bReadOnly=True)
+        try:
+            return set(i for (i,) in conn.execute('SELECT id FROM genomes'))
+        finally:
+            conn.close()
+
+    def testConcurrentWriters(self):
+        # every update of two concurrent writers must end up in the peak store,
+        # which must be stamped with the state of the table it was built from
+        numUpdates = 10
+        writers = []
+        for w in range(2):
+            peakFiles = [writePeakList(os.path.join(CUSTOM_DIR, 'peaks_%d_%d.tsv' % (w, u)),
+                                       ['W%d_%d_%d' % (w, u, g) for g in range(20)])
+                         for u in range(numUpdates)]
+            writers.append(mp.Process(target=addGenomes, args=(peakFiles,)))
+
+        for p in writers:
+            p.start()
+        for p in writers:
+            p.join()
+            self.assertEqual(p.exitcode, 0)
+
+        db = SqliteDb()
+        self.assertEqual(db.stamp(), 1 + 2 * numUpdates)
+
+        store = PeakStore(DefaultValues.CUSTOM_PEAK_STORE)
+        self.assertTrue(store.load(db.stamp()))
+        self.assertEqual(set(str(i) for i in store.ids), self.tableIds())
+        self.assertEqual(len(self.tableIds()), 2 * numUpdates * 20)
+
+    def testQueryMassDefaultTolerance(self):
+        # without a tolerance the default ppm of query_mass is used
+        SqliteDb().add([writePeakList(os.path.join(CUSTOM_DIR, 'peaks.tsv'), ['A0', 'A1'])])
+
+        hits = SqliteDb().queryMass([3000.5, 3010.0])
+        self.assertEqual(hits, SqliteDb().queryMass([3000.5, 3010.0], ppm=DefaultValues.QUERY_MASS_PPM))
+        self.assertEqual(sorted((mass, genomeId) for mass, genomeId, peak, peakClass in hits),
+                         [(3000.5, 'GCC_A0'), (3010.0, 'GCC_A1')])
+
+    def testExport(self):
+        # the pickle files keep the migrated state until they are exported,
+        # and exporting leaves the peak store of the SQLite file valid
+        SqliteDb().add([writePeakList(os.path.join(CUSTOM_DIR, 'peaks.tsv'), ['A0', 'A1'])])
+
+        pickles = Db()
+        pickles.loadDb()
+        self.assertEqual(pickles.ribo_db, {})
+
+        db = SqliteDb()
+        db.export()
+        pickles.loadDb()
+        self.assertEqual(set(pickles.ribo_db), self.tableIds())
+        self.assertEqual(pickles.names_db['GCC_A0'], 'Genome A0')
+
+        self.assertTrue(PeakStore(DefaultValues.CUSTOM_PEAK_STORE).load(db.stamp()))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,83 @@
+#!/usr/bin/env python
+
+__author__ = 'Yuji Sekiguchi'
+__copyright__ = 'Copyright (c) 2023 Yuji Sekiguchi, National Institute of Advanced Industrial Science and Technology (AIST)'
+__credits__ = ['Yuji Sekiguchi']
+__license__ = 'GPL3.0'
+__maintainer__ = 'Yuji Sekiguchi'
+__email__ = 'y.sekiguchi@aist.go.jp'
+__status__ = 'Development'
+
+import os
+import logging
+import unittest
+
+from tests import CUSTOM_DIR, resetCustomDb, writePeakList
+
+from GPMsDB_dbtk.db import SqliteDb, openDb
+from GPMsDB_dbtk.defaultValues import DefaultValues
+from GPMsDB_dbtk.identify import Identify, IdentifyBatch
+
+
+class TestIdentify(unittest.TestCase):
+    def setUp(self):
+        logging.getLogger('GPMsDB_tk').setLevel(logging.CRITICAL)
+        resetCustomDb()
+        SqliteDb.migrate()
+        SqliteDb().add([writePeakList(os.path.join(CUSTOM_DIR, 'peaks.tsv'), ['A%d' % i for i in range(5)])])
+
+    def testDefaultTolerance(self):
+        # without a tolerance the default ppm of identify is used
+        identify = Identify(openDb().peakStore())
+        peaks = [3020.5, 4020.5, 5020.5]
+
+        results = identify.identify(peaks)
+        self.assertEqual(results, identify.identify(peaks, ppm=DefaultValues.QUERY_MASS_PPM))
+        self.assertEqual(results[0].genomeId, 'GCC_A2')
+        self.assertEqual((results[0].matchedRibosomals, results[0].matchedOthers), (2, 1))
+
+
+class TestIdentifyBatch(unittest.TestCase):
+    def setUp(self):
+        logging.getLogger('GPMsDB_tk').setLevel(logging.CRITICAL)
+        resetCustomDb()
+        SqliteDb.migrate()
+        SqliteDb().add([writePeakList(os.path.join(CUSTOM_DIR, 'peaks.tsv'), ['A%d' % i for i in range(5)])])
+
+        self.peakDir = os.path.join(CUSTOM_DIR, 'spectra')
+        os.makedirs(self.peakDir)
+        self.outFile = os.path.join(CUSTOM_DIR, 'identified.tsv')
+
+    def writeSpectrum(self, name, masses):
+        peakFile = os.path.join(self.peakDir, name)
+        with open(peakFile, 'w') as fout:
+            fout.write('m/z\n' + ''.join('%.2f\n' % m for m in masses))
+
+        return peakFile
+
+    def spectra(self):
+        with open(self.outFile) as f:
+            return set(line.split('\t')[0] for line in f.readlines()[1:])
+
+    def testUnreadablePeakList(self):
+        # a peak list that can not be decoded fails the run, but every other
+        # peak list of the same worker is still scored
+        peakFiles = [self.writeSpectrum('s%d.txt' % i, [3000 + 10 * i, 4000 + 10 * i]) for i in range(5)]
+        badFile = os.path.join(self.peakDir, 'bad.txt')
+        with open(badFile, 'wb') as fout:
+            fout.write(b'\xff\xfe\xfa\n')
+
+        with self.assertRaises(SystemExit) as cm:
+            IdentifyBatch(1).run([badFile] + peakFiles, self.outFile)
+        self.assertEqual(cm.exception.code, 1)
+        self.assertEqual(self.spectra(), set('s%d.txt' % i for i in range(5)))
+
+    def testAllRead(self):
+        peakFiles = [self.writeSpectrum('s%d.txt' % i, [3000 + 10 * i, 4000 + 10 * i]) for i in range(5)]
+
+        IdentifyBatch(2).run(peakFiles, self.outFile)
+        self.assertEqual(self.spectra(), set('s%d.txt' % i for i in range(5)))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,73 @@
+#!/usr/bin/env python
+
+__author__ = 'Yuji Sekiguchi'
+__copyright__ = 'Copyright (c) 2023 Yuji Sekiguchi, National Institute of Advanced Industrial Science and Technology (AIST)'
+__credits__ = ['Yuji Sekiguchi']
+__license__ = 'GPL3.0'
+__maintainer__ = 'Yuji Sekiguchi'
+__email__ = 'y.sekiguchi@aist.go.jp'
+__status__ = 'Development'
+
+import os
+import shutil
+import tempfile
+import unittest
+
+import tests
+
+from GPMsDB_dbtk.main import OptionsParser
+
+
+class TestBinFiles(unittest.TestCase):
+    def setUp(self):
+        self.binDir = tempfile.mkdtemp(dir=tests.REF_DIR)
+
+    def tearDown(self):
+        shutil.rmtree(self.binDir)
+
+    def writeGenome(self, *path):
+        genomeFile = os.path.join(self.binDir, *path)
+        os.makedirs(os.path.dirname(genomeFile), exist_ok=True)
+        with open(genomeFile, 'w') as fout:
+            fout.write('>contig\nACGT\n')
+
+        return genomeFile
+
+    def testSymlinkCycle(self):
+        # linked directories are followed, but a link back to a parent must
+        # not make the recursive walk loop or report a genome twice
+        genomes = [self.writeGenome('a', 'g1.fna'), self.writeGenome('a', 'b', 'g2.fna')]
+        os.symlink(self.binDir, os.path.join(self.binDir, 'a', 'b', 'loop'))
+        os.symlink(os.path.join(self.binDir, 'a'), os.path.join(self.binDir, 'alias'))
+
+        self.assertEqual(len(list(OptionsParser().binFiles(self.binDir, '.fna', True))), 2)
+
+        linked = tempfile.mkdtemp(dir=tests.REF_DIR)
+        try:
+            os.symlink(linked, os.path.join(self.binDir, 'linked'))
+            genomes.append(os.path.join(self.binDir, 'linked', 'g3.fna'))
+            shutil.copy(genomes[0], os.path.join(linked, 'g3.fna'))
+
+            self.assertEqual(sorted(os.path.basename(f) for f in OptionsParser().binFiles(self.binDir, '.fna', True)),
+                             ['g1.fna', 'g2.fna', 'g3.fna'])
+        finally:
+            shutil.rmtree(linked)
+
+
+class TestPeakListFiles(unittest.TestCase):
+    def testUnmatchedPattern(self):
+        # a pattern matching nothing is reported even when other paths resolve
+        peakDir = tempfile.mkdtemp(dir=tests.REF_DIR)
+        try:
+            peakFile = tests.writePeakList(os.path.join(peakDir, 'peaks.tsv'), ['A0'])
+            with self.assertLogs('GPMsDB_tk', level='WARNING') as logs:
+                peakFiles = OptionsParser().peakListFiles([peakFile, os.path.join(peakDir, 'missing_*.tsv')])
+        finally:
+            shutil.rmtree(peakDir)
+
+        self.assertEqual(peakFiles, [peakFile])
+        self.assertIn('missing_*.tsv', logs.output[0])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,99 @@
+#!/usr/bin/env python
+
+__author__ = 'Yuji Sekiguchi'
+__copyright__ = 'Copyright (c) 2023 Yuji Sekiguchi, National Institute of Advanced Industrial Science and Technology (AIST)'
+__credits__ = ['Yuji Sekiguchi']
+__license__ = 'GPL3.0'
+__maintainer__ = 'Yuji Sekiguchi'
+__email__ = 'y.sekiguchi@aist.go.jp'
+__status__ = 'Development'
+
+import os
+import random
+import shutil
+import tempfile
+import unittest
+
+import tests
+
+from GPMsDB_dbtk.util.markerGeneFinder import MarkerGeneFinder
+
+# the stand-in hmmsearch of the benchmarks follows the E-value, domZ and
+# reporting rules of hmmsearch
+STUB_DIR = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'benchmarks', 'stubs')
+
+MARKER_NAMES = ['Ribosomal_L%d' % i for i in range(1, 21)]
+
+
+def writeMarkers(hmmFile):
+    with open(hmmFile, 'w') as fout:
+        for i, name in enumerate(MARKER_NAMES):
+            fout.write('HMMER3/f [3.1b2 | February 2015]\nNAME  %s\nACC   PF%05d.1\nLENG  %d\n//\n' % (name, 100 + i, 60 + 7 * i))
+
+
+def writeProteome(aaFile, numProteins, rng):
+    with open(aaFile, 'w') as fout:
+        for i in range(numProteins):
+            fout.write('>p%d\n%s\n' % (i, 'M' + ''.join(rng.choice('ACDEFGHIKLMNPQRSTVWY') for _ in range(rng.randint(40, 200)))))
+
+
+def readTable(tableFile):
+    # E-value, c-Evalue and i-Evalue of every reported domain
+    rows = {}
+    for line in open(tableFile):
+        if line[0] == '#' or line.strip() == '':
+            continue
+        lineSplit = line.split()
+        rows[(lineSplit[0], lineSplit[3], lineSplit[9])] = (float(lineSplit[6]), float(lineSplit[11]), float(lineSplit[12]))
+
+    return rows
+
+
+class TestBatchSearch(unittest.TestCase):
+    def setUp(self):
+        self.workDir = tempfile.mkdtemp(dir=tests.REF_DIR)
+        self.path = os.environ['PATH']
+        os.environ['PATH'] = STUB_DIR + os.pathsep + self.path
+
+    def tearDown(self):
+        os.environ['PATH'] = self.path
+        shutil.rmtree(self.workDir)
+
+    def testBatchMatchesSingleGenomes(self):
+        # the table of every genome of a batched search holds the domains a
+        # search of the genome on its own reports, with the same E-values
+        markerFile = os.path.join(self.workDir, 'markers.hmm')
+        writeMarkers(markerFile)
+
+        rng = random.Random(1)
+        genomes = []
+        for i, numProteins in enumerate([40, 300, 1500, 5000]):
+            binDir = os.path.join(self.workDir, 'bins', 'G%d' % i)
+            os.makedirs(binDir)
+            aaFile = os.path.join(binDir, 'genes_mw.faa')
+            writeProteome(aaFile, numProteins, rng)
+            genomes.append(('G%d' % i, binDir, aaFile, numProteins))
+
+        mgf = MarkerGeneFinder(1)
+        mgf.threadsPerSearch = 1
+        mgf._MarkerGeneFinder__searchBatch(markerFile, genomes, self.workDir, 'batch.txt')
+
+        numRows = 0
+        for binId, binDir, aaFile, numProteins in genomes:
+            mgf._MarkerGeneFinder__searchGenome(markerFile, aaFile, numProteins, os.path.join(binDir, 'single.txt'))
+
+            single = readTable(os.path.join(binDir, 'single.txt'))
+            batch = readTable(os.path.join(binDir, 'batch.txt'))
+            self.assertEqual(sorted(single), sorted(batch))
+            for key, evalues in single.items():
+                for expected, rescaled in zip(evalues, batch[key]):
+                    # E-values are printed with two significant digits, and
+                    # the batched ones are rounded again after rescaling
+                    self.assertAlmostEqual(rescaled / expected, 1.0, delta=0.15)
+            numRows += len(single)
+
+        self.assertGreater(numRows, 100)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,53 @@
+#!/usr/bin/env python
+
+__author__ = 'Yuji Sekiguchi'
+__copyright__ = 'Copyright (c) 2023 Yuji Sekiguchi, National Institute of Advanced Industrial Science and Technology (AIST)'
+__credits__ = ['Yuji Sekiguchi']
+__license__ = 'GPL3.0'
+__maintainer__ = 'Yuji Sekiguchi'
+__email__ = 'y.sekiguchi@aist.go.jp'
+__status__ = 'Development'
+
+import random
+import unittest
+
+import tests
+
+from GPMsDB_dbtk.mw import Mw, AA_AVERAGE, AA_MONOISOTOPIC, MET_CLEAVAGE, MW_SERIAL_PROTEINS
+
+
+def proteinMasses(seq):
+    # the per-protein loop calcMasses must reproduce exactly
+    if len(seq) > 1 and seq[0] == 'M' and seq[1] in MET_CLEAVAGE:
+        wa = 18.01056+1.00728-131.1926
+        wm = 18.01056+1.00728-131.04049
+    else:
+        wa = 18.01056+1.00728
+        wm = 18.01056+1.00728
+
+    for aa in seq:
+        if aa in AA_AVERAGE:
+            wa += AA_AVERAGE[aa]
+        if aa in AA_MONOISOTOPIC:
+            wm += AA_MONOISOTOPIC[aa]
+
+    return wa, wm
+
+
+class TestMw(unittest.TestCase):
+    def testSummationOrder(self):
+        # proteins finished one by one after the vectorised steps must get
+        # the same sums as the others
+        rng = random.Random(0)
+        residues = 'ACDEFGHIKLMNPQRSTVWYUOX*'
+        seqs = ['M' + ''.join(rng.choices(residues, k=rng.randint(0, 300))) for _ in range(500)]
+        seqs += ['M' + ''.join(rng.choices(residues, k=rng.randint(2000, 5000))) for _ in range(MW_SERIAL_PROTEINS + 4)]
+        seqs += ['M', 'MG', 'X']
+
+        wa, wm = Mw().calcMasses(seqs)
+        for seq, a, m in zip(seqs, wa.tolist(), wm.tolist()):
+            self.assertEqual((a, m), proteinMasses(seq))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,114 @@
+#!/usr/bin/env python
+
+__author__ = 'Yuji Sekiguchi'
+__copyright__ = 'Copyright (c) 2023 Yuji Sekiguchi, National Institute of Advanced Industrial Science and Technology (AIST)'
+__credits__ = ['Yuji Sekiguchi']
+__license__ = 'GPL3.0'
+__maintainer__ = 'Yuji Sekiguchi'
+__email__ = 'y.sekiguchi@aist.go.jp'
+__status__ = 'Development'
+
+import shutil
+import tempfile
+import unittest
+import numpy as np
+
+import tests
+
+from GPMsDB_dbtk.defaultValues import DefaultValues
+from GPMsDB_dbtk.peakStore import PeakStore
+
+
+def genomePeaks(genomeIds, seed):
+    rng = np.random.default_rng(seed)
+    ribosomals = {}
+    others = {}
+    for genomeId in genomeIds:
+        ribosomals[genomeId] = ['%.2f' % m for m in rng.uniform(3000, 15000, 20)]
+        others[genomeId] = ['%.2f' % m for m in rng.uniform(2000, 15000, 30)]
+
+    return ribosomals, others
+
+
+class TestPeakStore(unittest.TestCase):
+    def setUp(self):
+        self.storeDir = tempfile.mkdtemp(dir=tests.REF_DIR)
+        self.ribosomals, self.others = genomePeaks(['G%03d' % i for i in range(100)], 0)
+
+        store = PeakStore(self.storeDir)
+        store.fromDicts(self.ribosomals, self.others)
+        store.save(1)
+
+    def tearDown(self):
+        shutil.rmtree(self.storeDir)
+
+    def update(self, stamp, added=(), removed=()):
+        # changes the saved store and the dicts it should match the same way
+        store = PeakStore(self.storeDir)
+        self.assertTrue(store.load(stamp - 1))
+        if added:
+            ribosomals, others = genomePeaks(added, stamp)
+            store.add(ribosomals, others)
+            for genomeId in added:
+                self.ribosomals.pop(genomeId, None)
+                self.others.pop(genomeId, None)
+            self.ribosomals.update(ribosomals)
+            self.others.update(others)
+        if removed:
+            store.remove(removed)
+            for genomeId in removed:
+                del self.ribosomals[genomeId]
+                del self.others[genomeId]
+        store.save(stamp)
+
+        return store
+
+    def assertMatchesRebuild(self, stamp):
+        # a loaded store must answer queries like one built from scratch
+        store = PeakStore(self.storeDir)
+        self.assertTrue(store.load(stamp))
+        rebuilt = PeakStore(self.storeDir)
+        rebuilt.fromDicts(self.ribosomals, self.others)
+        rebuilt.buildIndex()
+
+        self.assertEqual(store.numGenomes(), rebuilt.numGenomes())
+        self.assertEqual([str(store.ids[i]) for i in store.select(minPeaks=1)],
+                         [str(rebuilt.ids[i]) for i in rebuilt.select(minPeaks=1)])
+
+        masses = np.random.default_rng(stamp).uniform(2000, 15000, 200)
+        hits = [(q, str(store.ids[g]), p, c) for q, g, p, c in zip(*store.matches(masses, ppm=500))]
+        rebuiltHits = [(q, str(rebuilt.ids[g]), p, c) for q, g, p, c in zip(*rebuilt.matches(masses, ppm=500))]
+        self.assertEqual(sorted(hits), sorted(rebuiltHits))
+        self.assertGreater(len(hits), 0)
+
+    def testDelta(self):
+        # small updates are saved as a delta next to the unchanged base
+        store = self.update(2, added=['N%03d' % i for i in range(10)], removed=['G001', 'G050'])
+        version = store.version
+        self.assertNotEqual(store.readCurrent()[1], PeakStore.NO_DELTA)
+        self.assertMatchesRebuild(2)
+
+        # genomes of the delta and of the base are replaced or removed
+        store = self.update(3, added=['N002', 'G010'], removed=['N005', 'G099'])
+        self.assertEqual(store.version, version)
+        self.assertMatchesRebuild(3)
+
+    def testCompaction(self):
+        minDelta, fraction = DefaultValues.PEAK_STORE_DELTA_MIN, DefaultValues.PEAK_STORE_DELTA_FRACTION
+        DefaultValues.PEAK_STORE_DELTA_MIN, DefaultValues.PEAK_STORE_DELTA_FRACTION = 5, 0.05
+        try:
+            store = self.update(2, added=['N%03d' % i for i in range(3)])
+            version = store.version
+            store = self.update(3, added=['N%03d' % i for i in range(3, 6)], removed=['G001', 'G002'])
+        finally:
+            DefaultValues.PEAK_STORE_DELTA_MIN, DefaultValues.PEAK_STORE_DELTA_FRACTION = minDelta, fraction
+
+        # the delta outgrew the threshold and was merged into a new base
+        self.assertNotEqual(store.version, version)
+        self.assertEqual(store.readCurrent()[1], PeakStore.NO_DELTA)
+        self.assertEqual(store.base.numGenomes(), 104)
+        self.assertMatchesRebuild(3)
+
+
+if __name__ == '__main__':
+    unittest.main()